@@ -10,6 +10,7 @@ import sys
 from pathlib import Path
 from datetime import datetime
 import functools
+import multiprocessing
 import os
 #sys.path.append(os.getcwd()) # hack for development
 from PySide2 import QtWidgets, QtCore, QtGui
@@ -402,6 +403,7 @@ class TrackTab(QtCore.QObject):
 
 if __name__ == "__main__": 
     # entry point
+    multiprocessing.freeze_support() # NOTE: labeler processes (spawn) re-run the frozen app without it
     app = QtWidgets.QApplication(sys.argv)
     ico = QtGui.QIcon("ui/s.ico")
     ret = app.setWindowIcon(ico)
@@ -0,0 +1,300 @@
+"""
+safas/frames.py
+
+Decoded frame access shared by the handler, labeler worker and writer.
+"""
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+
+import cv2
+import numpy as np
+
+from .sources import open_capture
+
+DEFAULT_CACHE_MB = 1024
+MAX_GRAB_GAP = 32 # frames skipped with grab() before a seek is cheaper
+DEFAULT_PREFETCH_DEPTH = 16
+DEFAULT_PREFETCH_MB = 256
+
+def plan_reads(frame_idxs, pos=None, max_gap=MAX_GRAB_GAP):
+    """ Plan one forward pass over frame_idxs starting from decoder position pos
+
+    Small gaps are skipped with grab(), which avoids the decode back from the
+        last keyframe that a seek costs for long-GOP codecs.
+
+    Parameters:
+    ----------
+        frame_idxs (iterable): frames needed, any order, duplicates ignored
+        pos (int): index of the next frame the decoder returns, None if unknown
+        max_gap (int): largest gap skipped with grab() instead of a seek
+    Returns:
+    ----------
+        plan (list): (frame_idx, seek, n_grab) in increasing frame_idx
+    """
+    plan = []
+    for frame_idx in sorted(set(frame_idxs)):
+        gap = None if pos is None else frame_idx - pos
+        if (gap is None) or (gap < 0) or (gap > max_gap):
+            plan.append((frame_idx, True, 0))
+        else:
+            plan.append((frame_idx, False, gap))
+        pos = frame_idx + 1
+    return plan
+
+def clip_roi(roi, width, height): 
+    """ clip roi (x, y, w, h) to the frame, None if the roi is empty or unset """
+    if roi is None: 
+        return None
+    x, y, w, h = [int(v) for v in roi]
+    x, y = min(max(x, 0), width), min(max(y, 0), height)
+    w, h = min(w, width - x), min(h, height - y)
+    if (w <= 0) | (h <= 0): 
+        return None
+    return (x, y, w, h)
+
+class FrameReader():
+    """ Read frames from a cap, tracking the decoder position to avoid seeks """
+    def __init__(self, cap, max_gap=MAX_GRAB_GAP):
+        self.cap = cap
+        self.max_gap = max_gap
+        self.pos = None # next frame returned by cap.read(), None if unknown
+
+    def read_frame(self, frame_idx):
+        """ return (ret, image) at frame_idx """
+        (_, seek, n_grab), = plan_reads([frame_idx], pos=self.pos, max_gap=self.max_gap)
+        return self._read(frame_idx, seek, n_grab)
+
+    def iter_frames(self, frame_idxs):
+        """ yield (frame_idx, ret, image) in increasing frame_idx """
+        for frame_idx, seek, n_grab in plan_reads(frame_idxs, pos=self.pos, max_gap=self.max_gap):
+            ret, image = self._read(frame_idx, seek, n_grab)
+            yield frame_idx, ret, image
+
+    def _read(self, frame_idx, seek, n_grab):
+        if seek:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+        else:
+            for _ in range(n_grab): self.cap.grab()
+        ret, image = self.cap.read()
+        self.pos = (frame_idx + 1) if ret else None
+        return ret, image
+
+class FrameCache():
+    """ LRU cache of decoded frames in front of a cv2.VideoCapture
+
+    Frames are decoded once and kept while they fit in max_bytes. The cache can
+        be shared between threads: lookups and decodes use separate locks so a
+        hit never waits on a decode in another thread. Zero-copy sources (see
+        safas.sources) are read directly and not cached.
+
+    Frames can be converted to grayscale and cropped to a region of interest 
+        as they are decoded, so the cache, queues and workers only carry the 
+        pixels that are analyzed. Objects labeled in a cropped frame are in ROI 
+        coordinates, offset by roi[:2] from full-frame coordinates. 
+
+    NOTE: frames are shared between callers and must not be modified in place
+    """
+    def __init__(self, cap, max_bytes=DEFAULT_CACHE_MB*2**20, source=None, source_kwargs=None, 
+                 grayscale=False, roi=None):
+        self.cap = cap
+        self.zero_copy = getattr(cap, "zero_copy", False)
+        self.grayscale = grayscale
+        self.frame_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.roi = clip_roi(roi, *self.frame_size) # (x, y, w, h) or None for the full frame
+        self.source = source # file cap was opened from, permits extra decoders
+        self.source_kwargs = dict() if source_kwargs is None else source_kwargs
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reader = FrameReader(cap)
+        self._frames = OrderedDict()
+        self._lock = Lock() # guards _frames, nbytes
+        self._cap_lock = Lock() # guards the decoder position of cap
+
+    def __len__(self): return len(self._frames)
+
+    def __contains__(self, frame_idx): return frame_idx in self._frames
+
+    def get(self, prop):
+        """ pass-through to cap.get so the cache can stand in for the cap """
+        return self.cap.get(prop)
+
+    def read_frame(self, frame_idx):
+        """ return (ret, image) at frame_idx, decoding only on a cache miss """
+        if self.zero_copy: return self._decode(self.cap, frame_idx)
+
+        image = self._lookup(frame_idx)
+        if image is not None:
+            return True, image
+
+        with self._cap_lock:
+            image = self._lookup(frame_idx, count=False) # decoded by another thread while waiting
+            if image is not None:
+                return True, image
+            ret, image = self._decode(self.reader, frame_idx)
+
+        if ret: self._put(frame_idx, image)
+        return ret, image
+
+    def iter_frames(self, frame_idxs, reader=None):
+        """ yield (frame_idx, ret, image) in increasing frame_idx
+
+        Cache misses are decoded in one forward pass (see plan_reads) rather
+            than with a seek per frame. Pass a reader from open_reader() to 
+            decode misses on a private cap, in parallel with other readers.
+        """
+        for frame_idx in sorted(set(frame_idxs)):
+            if (reader is None) | self.zero_copy: 
+                ret, image = self.read_frame(frame_idx)
+                yield frame_idx, ret, image
+                continue
+
+            image = self._lookup(frame_idx)
+            if image is not None: 
+                yield frame_idx, True, image
+                continue
+            ret, image = self._decode(reader, frame_idx)
+            if ret: self._put(frame_idx, image)
+            yield frame_idx, ret, image
+
+    def open_reader(self):
+        """ FrameReader on a new capture of the same source """
+        if self.source is None: 
+            raise ValueError("FrameCache has no source to open another reader from")
+        return FrameReader(open_capture(self.source, **self.source_kwargs))
+
+    def transform(self, image): 
+        """ crop to roi and convert to grayscale as configured """
+        if self.roi is not None: 
+            x, y, w, h = self.roi
+            image = image[y:(y+h), x:(x+w)]
+        if self.grayscale & (image.ndim == 3): 
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        elif (self.roi is not None) & (not self.zero_copy): 
+            image = np.ascontiguousarray(image) # NOTE: do not keep the full decoded frame alive in the cache
+        return image
+
+    def to_full_frame(self, image): 
+        """ place a roi frame on a blank full-size frame, e.g. for display """
+        if self.roi is None: 
+            return image
+        x, y, w, h = self.roi
+        full = np.zeros((self.frame_size[1], self.frame_size[0]) + image.shape[2:], dtype=image.dtype)
+        full[y:(y+h), x:(x+w)] = image
+        return full
+
+    def _decode(self, reader, frame_idx): 
+        ret, image = reader.read_frame(frame_idx)
+        if ret: image = self.transform(image)
+        return ret, image
+
+    def _lookup(self, frame_idx, count=True):
+        with self._lock:
+            image = self._frames.get(frame_idx)
+            if image is not None:
+                self._frames.move_to_end(frame_idx)
+            if count:
+                if image is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            return image
+
+    def _put(self, frame_idx, image):
+        if image.nbytes > self.max_bytes:
+            return None
+        with self._lock:
+            if frame_idx in self._frames:
+                return None
+            self._frames[frame_idx] = image
+            self.nbytes += image.nbytes
+            while self.nbytes > self.max_bytes: # evict least recently used
+                _, old = self._frames.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._frames = OrderedDict()
+            self.nbytes = 0
+
+    def release(self):
+        self.clear()
+        with self._cap_lock:
+            self.reader.pos = None
+            self.cap.release()
+
+class Prefetcher():
+    """ Decode frames ahead of the viewer in a background thread
+
+    Each frame shown is passed to notify(). The prefetcher follows the direction
+        of travel and decodes the next frames into the FrameCache, so stepping
+        forward or back through a video reads from the cache instead of the 
+        decoder. Forward, a new request interrupts the current pass. Backward, 
+        depth frames up to the nearest frame needed are decoded in one forward 
+        pass (one seek), which is not interrupted. Decoding uses a private 
+        reader when the source can be reopened, so it never holds the decoder 
+        used by build_frame. Not used for zero-copy sources, which are not cached.
+
+    Parameters:
+    ----------
+        frames (FrameCache): cache to fill
+        depth (int): number of frames to decode ahead
+        max_bytes (int): limit on the bytes decoded ahead, caps depth
+    """
+    def __init__(self, frames, depth=DEFAULT_PREFETCH_DEPTH, max_bytes=DEFAULT_PREFETCH_MB*2**20):
+        self.frames = frames
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.frame_count = int(frames.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.last_idx = None
+        self.direction = 1
+        self._request = None
+        self._stop = False
+        self._cond = Condition()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def notify(self, frame_idx):
+        """ record the frame shown, prefetch ahead of it """
+        with self._cond:
+            if (self.last_idx is not None) and (frame_idx != self.last_idx):
+                self.direction = 1 if frame_idx > self.last_idx else -1
+            self.last_idx = frame_idx
+            self._request = (frame_idx, self.direction)
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        reader = self.frames.open_reader() if self.frames.source is not None else None
+        depth = self.depth
+        try:
+            while True:
+                with self._cond:
+                    while (self._request is None) and (not self._stop):
+                        self._cond.wait()
+                    if self._stop:
+                        return None
+                    frame_idx, direction = self._request
+                    self._request = None
+
+                frame_idxs = [frame_idx + direction*i for i in range(1, depth + 1)] # nearest first
+                frame_idxs = [i for i in frame_idxs if (0 <= i < self.frame_count) and (i not in self.frames)]
+                if len(frame_idxs) == 0: 
+                    continue
+                interrupt = direction > 0
+                if not interrupt: # NOTE: decoding backward seeks per frame, instead one forward pass of depth frames
+                    # up to the nearest frame needed, not interrupted until that frame is cached
+                    frame_idxs = [i for i in range(max(0, frame_idxs[0] - depth + 1), frame_idxs[0] + 1) if i not in self.frames]
+                for _, ret, image in self.frames.iter_frames(frame_idxs, reader=reader):
+                    if ret and (image.nbytes*depth > self.max_bytes): # first frame decoded sets the depth
+                        depth = max(1, self.max_bytes//image.nbytes)
+                    if self._stop or (interrupt and (self._request is not None)): # viewer moved on, plan again
+                        break
+        finally:
+            if reader is not None: reader.cap.release()
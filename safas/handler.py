@@ -25,6 +25,10 @@ from rich import progress
 
 from .prints import print_handler as print
 from . import labeler_worker
+from .frames import FrameCache, Prefetcher, DEFAULT_CACHE_MB, DEFAULT_PREFETCH_DEPTH, DEFAULT_PREFETCH_MB
+from .sources import open_capture, DEFAULT_FPS
+from .results import ResultStore
+from .tracks import TrackStore
 
 from .labelers.edge_gradient import labeler as edge_gradient
 from .linkers.linear_flocs import linker as linear_flocs
@@ -40,6 +44,12 @@ writer_modules = {
     "sed_exp": sed_exp
 }
 
+NODE_EXTRAS = { # optional node functions and flags, None if the module has none
+    "batch_func": "{node_type}_batch", # label a stack of frames (see labeler_worker.run_labeler)
+    "trace_func": "trace_contours", # contours of objects labeled without them (see trace_track_contours)
+    "stage_cache": "STAGE_CACHE", # labeler takes stage_cache, keeps the stages of a frame for the next call
+}
+
 DEFAULT_CONFIG = {
     "output_path": None, 
     "auto_reload": True
@@ -97,11 +107,14 @@ class Handler(QtCore.QObject):
             self.qt_interactor = None
 
         self.objs = dict()
-        self.tracks = dict() 
+        self.tracks = TrackStore() 
         self.annotations = dict()
-        self.next_track_idx = 1
         self.config = None
         self.cap = None
+        self.frames = None
+        self.prefetcher = None
+        self.background = None # (settings, BackgroundModel) continued across run_labeler calls
+        self.results = None
         self.linker = None
         self.labeler = None
 
@@ -200,40 +213,68 @@ class Handler(QtCore.QObject):
             print(f"[cyan]Source[/cyan] No data file selected")
             return None
         
-        # TODO: decide which loader to used based on file content
-        # TODO: permit other video types, file sequence, single images
+        # TODO: permit other video types, single images
         supported = [
             'video/x-msvideo', 
+            'image/tiff', # uncompressed (multipage) TIFF, memory-mapped
+            'inode/directory', # image sequence, one frame per file
         ]  
         
-        try:
-            kind = filetype.guess(data_file)
-        except FileNotFoundError as e: 
-            print(f'[cyan]Source[/cyan] does not exist: {data_file}')
-            self.qt_interactor.ui_video_loaded_signal.emit(False)
-            self.params[("io","data_file")] = ""
-            return None
-        
-        if kind is None:
-            print(f'[cyan]Source[/cyan] cannot determine file type of {data_file}')
-            self.qt_interactor.ui_video_loaded_signal.emit(False)
-            return None
+        if Path(data_file).is_dir(): 
+            mime = "inode/directory"
+            print(f'[cyan]Source[/cyan] image sequence in directory {data_file}')
         else: 
+            try:
+                kind = filetype.guess(data_file)
+            except FileNotFoundError as e: 
+                print(f'[cyan]Source[/cyan] does not exist: {data_file}')
+                self.qt_interactor.ui_video_loaded_signal.emit(False)
+                self.params[("io","data_file")] = ""
+                return None
+            
+            if kind is None:
+                print(f'[cyan]Source[/cyan] cannot determine file type of {data_file}')
+                self.qt_interactor.ui_video_loaded_signal.emit(False)
+                return None
             print(f'[cyan]Source[/cyan] file extension: {kind.extension}, MIME type: {kind.mime}')
-            if kind.mime == "video/x-msvideo": 
-                self.cap = load_video(data_file)
-                width, height, fps, frame_count = get_video_frame_details(self.cap) 
-
-                if USE_QT: 
-                    try: 
-                        self.qt_interactor.frame_count_signal.emit(0, frame_count)
-                        self.qt_interactor.ui_video_loaded_signal.emit(True)
-                    except Exception as e: 
-                        print(f"Frame count not emitted by qt_interactor: {e}")
-                self.build_frame(0) # default beginning of file
-            else: 
-                print(f"Supported MIME types: {supported} ")
+            mime = kind.mime
+
+        if mime in supported: 
+            if self.prefetcher is not None: self.prefetcher.stop()
+            if self.frames is not None: self.frames.release()
+            self.prefetcher = None
+            self.background = None
+            # NOTE: fps is read from params for sources that do not store it
+            source_kwargs = {
+                "fps": self.params.get(("io", "fps"), DEFAULT_FPS), 
+                "ingest_video": self.params.get(("io", "ingest"), False),
+            }
+            self.cap = load_video(data_file, **source_kwargs)
+            if self.cap is None: 
                 self.qt_interactor.ui_video_loaded_signal.emit(False)
+                return None
+            cache_mb = self.params.get(("io", "frame_cache_mb"), DEFAULT_CACHE_MB)
+            roi = [self.params.get(("io", "roi", key), 0) for key in ["x", "y", "w", "h"]]
+            self.frames = FrameCache(self.cap, max_bytes=int(cache_mb*2**20), source=data_file, 
+                                     source_kwargs=source_kwargs, 
+                                     grayscale=self.params.get(("io", "grayscale"), False), 
+                                     roi=roi) # NOTE: roi with w or h of 0 is the full frame
+            prefetch_depth = self.params.get(("io", "prefetch_depth"), DEFAULT_PREFETCH_DEPTH)
+            if (prefetch_depth > 0) & (not self.frames.zero_copy): # NOTE: zero-copy frames are not cached
+                prefetch_mb = self.params.get(("io", "prefetch_mb"), DEFAULT_PREFETCH_MB)
+                self.prefetcher = Prefetcher(self.frames, depth=prefetch_depth, max_bytes=int(prefetch_mb*2**20))
+            width, height, fps, frame_count = get_video_frame_details(self.cap) 
+
+            if USE_QT: 
+                try: 
+                    self.qt_interactor.frame_count_signal.emit(0, frame_count)
+                    self.qt_interactor.ui_video_loaded_signal.emit(True)
+                except Exception as e: 
+                    print(f"Frame count not emitted by qt_interactor: {e}")
+            self.build_frame(0) # default beginning of file
+        else: 
+            print(f"Supported MIME types: {supported} ")
+            self.qt_interactor.ui_video_loaded_signal.emit(False)
 
     def load_node(self, node_name, *args, **kwargs): 
         """ Load function and parameters for LABELER or LINKER"""
@@ -250,7 +291,7 @@ class Handler(QtCore.QObject):
             print(f"{node_name} func_name and file_name not loaded: {e}")
         
         try: 
-            setup, func, params_list, errors = self.load_node_module(func_name, node_name)
+            setup, func, extras, params_list, errors = self.load_node_module(func_name, node_name)
 
             if len(errors) > 0: 
                 print(f"One or more {node_name} attributes not loaded:", warning=True)
@@ -265,6 +306,7 @@ class Handler(QtCore.QObject):
         try: 
             setattr(getattr(self, node_name), "setup", setup)
             setattr(getattr(self, node_name), "func", func)
+            for key in extras: setattr(getattr(self, node_name), key, extras[key])
             setattr(getattr(self, node_name), "name", func_name)
             print(f"[cyan]{node_name.title()}[/cyan] [dark_green]{func_name}[/dark_green] registered")
         except Exception as e: 
@@ -301,6 +343,7 @@ class Handler(QtCore.QObject):
         ----------
             setup, function: called on filter setup (eg load required model)
             filter, function: called during image processing
+            extras, dict: optional functions and flags of the module, see NODE_EXTRAS
             params_list, list: parameters for pg.ParameterTree and pg.Parameter    
 
         Note:
@@ -321,6 +364,8 @@ class Handler(QtCore.QObject):
             func = None
             errors[f"{node_type}.{node_type}"] = e
 
+        extras = {key: getattr(mod, name.format(node_type=node_type), None) for key, name in NODE_EXTRAS.items()}
+
         try: 
             setup = mod.setup
         except Exception as e: 
@@ -333,7 +378,7 @@ class Handler(QtCore.QObject):
             params_list = None
             errors[f"{node_type}.params"] = e
         
-        return (setup, func, params_list, errors)
+        return (setup, func, extras, params_list, errors)
 
     def build_frame(self, frame_idx):  
         """Assemble frame at given index for front-end"""
@@ -383,8 +428,13 @@ class Handler(QtCore.QObject):
                 print(f"[cyan]Linker[/cyan] error: {e}", errror=True)
         
         try:  # Update to latest frame
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, vi)
-            result, image = self.cap.read()
+            result, image = self.frames.read_frame(vi)
+            if self.prefetcher is not None: self.prefetcher.notify(vi)
+            image = self.frames.to_full_frame(image) # objects are in full-frame coordinates
+            if image.ndim == 2: 
+                image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) # viewer shows 3 channels
+            elif not image.flags.writeable: 
+                image = image.copy() # NOTE: zero-copy sources return read-only views
         except Exception as e: 
             print(f"Could not get image from cap: {e}")
 
@@ -431,21 +481,43 @@ class Handler(QtCore.QObject):
             n_frames = x2 - x1 + 1
             # max 1 thread per image
             n_threads = min(n_frames, multiprocessing.cpu_count() - 1)
+            n_decoders = self.params.get(("io", "n_decoders"), 1)
+            backend = self.params.get(("io", "backend"), "thread")
         elif process_on_new_frame: 
             n_frames = 1
             x1, x2 = image_index, image_index
             n_threads = 1
+            n_decoders = 1
+            backend = "thread" # NOTE: starting processes costs more than one frame
         
-        print(f"[cyan]Labeler[/cyan] [dark_green]{self.labeler.name}[/dark_green] on {n_frames} images from {x1} to {x2} with {n_threads} threads")
+        print(f"[cyan]Labeler[/cyan] [dark_green]{self.labeler.name}[/dark_green] on {n_frames} images from {x1} to {x2} with {n_threads} {backend}s")
         start = time.perf_counter()
 
         try:  
             labeler_kwargs = flatten_dict.unflatten(self.params)["labeler"]["kwargs"]
         except Exception as e: 
             print(f"labeler kwargs not loaded from params: {e}")
+        if (n_frames == 1) & bool(getattr(self.labeler, "stage_cache", None)): 
+            labeler_kwargs["stage_cache"] = True # NOTE: tuning a filter on this frame reuses the earlier stages
         
+        background = None
+        if self.params.get(("io", "background", "apply"), False): 
+            background = {key[2]: self.params[key] for key in self.params if (key[:2] == ("io", "background")) & (key[2] != "apply")}
+
+        results = self.result_store(labeler_kwargs, background) 
+        objs = dict() if results is None else results.read(range(x1, x2+1))
+        if len(objs) > 0: 
+            print(f"[cyan]Results[/cyan] {len(objs)} of {n_frames} images read from {results.path}")
+
         # TODO: run in thread and release UI
-        objs = labeler_worker.run_labeler(self.cap, x1, x2, n_threads, self.labeler.func, labeler_kwargs)
+        for y1, y2 in contiguous_runs([frame_idx for frame_idx in range(x1, x2+1) if frame_idx not in objs]): 
+            objs_run = labeler_worker.run_labeler(self.frames, y1, y2, min(n_threads, y2 - y1 + 1), self.labeler.func, 
+                                                  labeler_kwargs, n_decoders=n_decoders, backend=backend, 
+                                                  background=self.background_model(background), 
+                                                  batch_func=None if n_frames == 1 else getattr(self.labeler, "batch_func", None))
+            if (results is not None) & (n_frames > 1): # NOTE: single frames are labeled while tuning, not stored
+                results.write(objs_run)
+            objs.update(objs_run)
         self.objs.update(objs)
         finish = time.perf_counter()
       
@@ -468,6 +540,33 @@ class Handler(QtCore.QObject):
         print(f"Processed {n_frames} images in {finish-start:0.1f} second(s)") 
         return x2
 
+    def background_model(self, background): 
+        """ BackgroundModel of the background settings, kept so stepping to the next frame continues it 
+            (see labeler_worker.continue_background). A new model is started when the settings, source 
+            or roi change.
+        """
+        if background is None: 
+            return None
+        key = (sorted(background.items()), self.frames.source, self.frames.roi)
+        if (self.background is None) or (self.background[0] != key): 
+            self.background = (key, labeler_worker.BackgroundModel(**background))
+        return self.background[1]
+
+    def result_store(self, labeler_kwargs, background=None): 
+        """ ResultStore of the current source and labeler settings, None if not enabled """
+        data_file = self.params.get(("io", "data_file"))
+        if (not self.params.get(("io", "result_cache"), False)) or (data_file is None) or (data_file == ""): 
+            return None
+        settings = {
+            "labeler": self.labeler.name, 
+            "kwargs": {key: value for key, value in labeler_kwargs.items() if key != "stage_cache"}, 
+            "roi": self.frames.roi, 
+            "background": background, 
+        }
+        if (self.results is None) or (self.results.data_file != str(data_file)) or (self.results.settings != settings): 
+            self.results = ResultStore(data_file, settings)
+        return self.results
+
     def run_linker(self,
             frame_idx=None, 
             process_on_new_frame=True, 
@@ -521,12 +620,11 @@ class Handler(QtCore.QObject):
 
     def add_obj_to_track(self, frame_idx, obj_idx): 
         """ """
-        track_idx = self.next_track_idx
+        track_idx = self.tracks.new_track_idx()
         obj = self.objs[frame_idx][obj_idx] # removed from open objs
         obj["track_idx"] = track_idx
         obj["match_error"] = 0
         self.tracks[(track_idx, frame_idx)] = obj
-        self.next_track_idx += 1
         self.objs[frame_idx].pop(obj_idx)
         return track_idx
 
@@ -534,19 +632,15 @@ class Handler(QtCore.QObject):
         self.objs = dict()
 
     def clear_all_tracks(self, ): 
-        track_idxs = list(set([k[0] for k in self.tracks]))
+        track_idxs = self.tracks.track_idxs()
         for track_idx in track_idxs: 
             self.remove_track(track_idx)  # dict() # TODO: add confirm before doing this
 
     def remove_track(self, track_idx): 
         """ """
-        keys = [key for key in self.tracks if (key[0]==(track_idx))]
-        
-        for track_idx, frame_idx in keys: # put objs back into data structure
-            obj = self.tracks[(track_idx, frame_idx)]
+        for frame_idx, obj in self.tracks.remove_track(track_idx).items(): # put objs back into data structure
             obj_idx = obj["obj_idx"]
             self.objs[frame_idx][obj_idx] = obj
-            self.tracks.pop((track_idx, frame_idx)) 
 
     def update_params(self, new_params): 
         """ """
@@ -567,7 +661,7 @@ class Handler(QtCore.QObject):
 
     def get_items_in_frame(self, frame_idx): 
 
-        track_idxs = list(set([l[0] for l in list(self.tracks.keys()) if l[1]==frame_idx]))
+        track_idxs = self.tracks.in_frame(frame_idx)
 
         try: 
             obj_idxs = list(self.objs[frame_idx])
@@ -586,7 +680,7 @@ class Handler(QtCore.QObject):
             tracks_an = None
         else: 
             if track_idxs is None: 
-                track_idxs = list(set([l[0] for l in self.tracks if l[1] <=(frame_idx)]))
+                track_idxs = self.tracks.track_idxs(frame_max=frame_idx)
 
             if isinstance(track_idxs, int): 
                 track_idxs = [track_idxs]
@@ -595,15 +689,15 @@ class Handler(QtCore.QObject):
                 return None
             
             for track_idx in track_idxs:   
-                keys = [key for key in self.tracks if ((key[0]==track_idx) & (key[1]<=(frame_idx)))]
+                track = self.tracks.track(track_idx, frame_max=frame_idx)
        
                 if params_t["tracks"]["show_lines"]: 
-                    centroids = np.array([self.tracks[key]["obj_centroid"] for key in keys])
+                    centroids = self.tracks.track_arrays(track_idx, ["obj_centroid"], frame_max=frame_idx)["obj_centroid"]
                 else: 
                     centroids = None
                 
                 if params_t["tracks"]["show_objs"]: 
-                    contour = [self.tracks[key]["obj_contour"] for key in keys]
+                    contour = [obj_outline(obj["obj_contour"], obj["obj_bbox"]) for obj in track.values()]
                 else: 
                     contour = None
 
@@ -624,10 +718,37 @@ class Handler(QtCore.QObject):
             if isinstance(obj_idxs, int): obj_idxs = [obj_idxs]
 
             for obj_idx in obj_idxs: 
-                item = {"obj_contour": self.objs[frame_idx][obj_idx]["obj_contour"]}
+                objs_f = self.objs[frame_idx]
+                item = {"obj_contour": obj_outline(objs_f.value(obj_idx, "obj_contour"), objs_f.value(obj_idx, "obj_bbox"))}
                 objs_an["objs"][obj_idx] = item
         return objs_an
   
+    def trace_track_contours(self): 
+        """ trace the contours of tracked objects labeled without them (e.g. centroids_only) """
+        trace_func = getattr(self.labeler, "trace_func", None)
+        keys_f = dict() # frame_idx: track keys
+        for key in self.tracks: 
+            if self.tracks[key].get("obj_contour") is None: 
+                keys_f.setdefault(key[1], []).append(key)
+        if (trace_func is None) | (len(keys_f) == 0): 
+            return None
+
+        labeler_kwargs = flatten_dict.unflatten(self.params)["labeler"]["kwargs"]
+        x0, y0 = (0, 0) if self.frames.roi is None else self.frames.roi[:2] # objects are in full-frame coordinates
+        n = 0
+        for frame_idx, ret, src in self.frames.iter_frames(keys_f): 
+            if not ret: continue
+            keys = keys_f[frame_idx]
+            bbox = np.array([self.tracks[key]["obj_bbox"] for key in keys]) - np.array([x0, y0, 0, 0])
+            area = [self.tracks[key]["obj_area"] for key in keys]
+            for key, contour in zip(keys, trace_func(src, bbox, area, **labeler_kwargs)): 
+                if contour is None: continue
+                contour = contour + np.array([x0, y0], dtype=contour.dtype)
+                self.tracks[key]["obj_contour"] = contour
+                self.tracks[key]["obj_contour_cv"] = [contour.reshape(-1, 1, 2)]
+                n += 1
+        print(f"[cyan]Labeler[/cyan] contours traced for {n} tracked objects")
+
     def save_tracks(self): 
         if self.cap is None: 
             print(f"[cyan]Source[/cyan] not loaded", warning=True)   
@@ -647,7 +768,8 @@ class Handler(QtCore.QObject):
         output_path = Path(output_path).joinpath(microtime())
         os.makedirs(output_path, exist_ok=True)
 
-        self.tracks, self.objs, dft, dfx = self.writer.func(output_path, tracks=self.tracks, objs=self.objs, cap=self.cap, **writer_kwargs)
+        self.trace_track_contours()
+        self.tracks, self.objs, dft, dfx = self.writer.func(output_path, tracks=self.tracks, objs=self.objs, cap=self.frames, **writer_kwargs)
         
         clear_objs = writer_kwargs["clear_objs_on_save"]
         clear_tracks = writer_kwargs["clear_tracks_on_save"]
@@ -706,15 +828,14 @@ class Handler(QtCore.QObject):
         output_path = Path(output_path).joinpath(microtime())
         os.makedirs(output_path, exist_ok=True)
 
-        monitor = progress.track(self.objs, description='[green] Saving objects & frames', total=len(self.objs))
+        monitor = progress.track(sorted(self.objs), description='[green] Saving objects & frames', total=len(self.objs))
 
         for frame_idx in monitor: 
             with open(str(output_path.joinpath(f"objs_in_frame_{frame_idx:05d}.obj")), "wb") as f: 
                 pickle.dump(self.objs[frame_idx], f)
      
             if write_frames: 
-                self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-                ret, frame = self.cap.read()
+                ret, frame = self.frames.read_frame(frame_idx)
                 filename = str(output_path.joinpath(f"{frame_idx:05d}.png"))
                 if frame is not None: 
                     cv2.imwrite(str(output_path.joinpath(f"{frame_idx:05d}.png")), frame)
@@ -835,6 +956,23 @@ def load_json(filename, display_params=False):
         print(f"Params not loaded from {filename}: {e}")
         return None
 
+def obj_outline(contour, bbox): 
+    """ contour, or the corners of bbox for objects labeled without one """
+    if contour is not None: 
+        return contour
+    x, y, w, h = bbox
+    return np.array([[x, y], [x + w - 1, y], [x + w - 1, y + h - 1], [x, y + h - 1]])
+
+def contiguous_runs(frame_idxs): 
+    """ (first, last) of each run of consecutive frame_idxs """
+    runs = []
+    for frame_idx in sorted(frame_idxs): 
+        if (len(runs) > 0) and (frame_idx == runs[-1][1] + 1): 
+            runs[-1][1] = frame_idx
+        else: 
+            runs.append([frame_idx, frame_idx])
+    return [tuple(run) for run in runs]
+
 def get_video_frame_details(cap): 
 
     try: 
@@ -849,10 +987,10 @@ def get_video_frame_details(cap):
     
     return (width, height, fps, frame_count)
 
-def load_video(data_file): 
-    """ """
+def load_video(data_file, fps=DEFAULT_FPS, ingest_video=False): 
+    """ video file, image directory or TIFF stack (see safas.sources.open_capture) """
     try: 
-        cap = cv2.VideoCapture(data_file)
+        cap = open_capture(data_file, fps=fps, ingest_video=ingest_video)
         try: 
             ret, out = cap.read() 
             print(f"[cyan]Video[/cyan] loaded: {data_file}")
@@ -3,13 +3,18 @@
 """
 from copy import deepcopy
 import cv2
+import numpy as np
 
 from threading import Thread
-from queue import Queue
-from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
 
 from rich.progress import Progress
 
+from .objects import ObjectTable
+
 import logging
 log = logging.getLogger("rich")
 
@@ -31,24 +36,290 @@ def print_process(
 
 def print(*args, **kwargs): print_process("bright_yellow", "labeler", *args, **kwargs)
 
-def _producer(q_in, cap, x1, x2):
-    """ """
-    cap.set(cv2.CAP_PROP_POS_FRAMES, x1)
-    for frame_idx in range(x1, x2+1):
-        result, image = cap.read()
-        q_in.put((image, frame_idx))
-    q_in.put((None, None))
+MIN_SEGMENT_FRAMES = 25 # shorter segments spend more time seeking than decoding
+BACKENDS = ["thread", "process"]
+RING_SLOTS_PER_WORKER = 2 # frames in shared memory per labeler process
+BATCH_BYTES = 8*2**20 # frames per labeler batch, so the frames and scratch arrays of a batch stay in cache
+MAX_BATCH_FRAMES = 16
+
+BACKGROUND_METHODS = ["median", "mean"]
+
+class BackgroundModel(): 
+    """ Rolling background of a frame sequence, masks the foreground of each new frame
+
+    Parameters:
+    ----------
+        method (str): "median", a running median kept incrementally (the background 
+            steps one gray level towards each frame), or "mean", a running average 
+        history (int): frames the model starts from, and the frames the mean adapts over
+        fg_thresh (int): difference from the background (gray levels) that is foreground
+        dilate_px (int): grow the foreground by dilate_px so the edges of objects
+            (blur, gradients) stay in it
+    """
+    def __init__(self, method="median", history=50, fg_thresh=15, dilate_px=3, **kwargs): 
+        if method not in BACKGROUND_METHODS: 
+            print(f"background method {method} not in {BACKGROUND_METHODS}, using median", warning=True)
+            method = "median"
+        self.method = method
+        self.history = max(1, int(history))
+        self.fg_thresh = fg_thresh
+        self.kernel = np.ones((2*int(dilate_px) + 1,)*2, dtype=np.uint8)
+        self.bg = None
+        self.frame_idx = None # last frame added to the model, None if unknown (e.g. after start)
+        self.mask = None # foreground of frame_idx
+
+    def start(self, images): 
+        """ background from a stack of frames, e.g. those before the first frame labeled """
+        stack = np.stack([to_gray(image) for image in images])
+        if self.method == "median": 
+            self.bg = np.median(stack, axis=0).astype(np.uint8)
+        else: 
+            self.bg = stack.mean(axis=0, dtype=np.float32)
+        self.frame_idx, self.mask = None, None
+
+    def update(self, gray): 
+        if self.bg is None: 
+            return self.start([gray])
+        if self.method == "median": 
+            up, down = gray > self.bg, gray < self.bg
+            self.bg += up
+            self.bg -= down
+        else: 
+            cv2.accumulateWeighted(gray, self.bg, 1/self.history)
+
+    def foreground(self, image, frame_idx=None): 
+        """ foreground mask (uint8, 255 in the foreground) of image, then add image (at frame_idx) to the model """
+        gray = to_gray(image)
+        if self.bg is None: 
+            self.start([gray])
+        bg = self.bg if self.method == "median" else cv2.convertScaleAbs(self.bg)
+        _, mask = cv2.threshold(cv2.absdiff(gray, bg), self.fg_thresh, 255, cv2.THRESH_BINARY)
+        mask = cv2.dilate(mask, self.kernel)
+        self.update(gray)
+        self.frame_idx, self.mask = frame_idx, mask
+        return mask
+
+def to_gray(image): return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+def warmup_frames(x1, history, frame_count): 
+    """ frames the background model starts from: the history before x1, or after it at the start of the video """
+    if x1 > 0: 
+        return list(range(max(0, x1 - history), x1))
+    return list(range(x1 + 1, min(frame_count, x1 + 1 + history)))
+
+def continue_background(model, frames, x1, reader=None): 
+    """ bring model up to the frame before x1
+    
+    The model continues through the frames after the last frame it saw if x1 is at 
+        most model.history frames after it (e.g. stepping forward, or frames read 
+        from a ResultStore), otherwise it is re-warmed (see warmup_frames)
+    """
+    if model.frame_idx is None: 
+        continued = False
+    elif model.frame_idx == x1: # NOTE: x1 labeled again, its mask is reused
+        continued = model.mask is not None
+    else: 
+        continued = x1 - model.history <= model.frame_idx < x1
+    if continued: 
+        for frame_idx, result, image in frames.iter_frames(range(model.frame_idx + 1, x1), reader=reader): 
+            if result: 
+                model.update(to_gray(image))
+                model.frame_idx, model.mask = frame_idx, None
+        return model
+    idxs = warmup_frames(x1, model.history, int(frames.get(cv2.CAP_PROP_FRAME_COUNT)))
+    images = [image for _, result, image in frames.iter_frames(idxs, reader=reader) if result]
+    if len(images) > 0: 
+        model.start(images)
+    else: 
+        model.bg, model.frame_idx, model.mask = None, None, None
+    return model
+
+def _producer(q_in, frames, x1, x2, private_reader=False, model=None):
+    """ frames (safas.frames.FrameCache): decoded frames shared with the handler
+    
+        model (BackgroundModel): continued from the frame before x1 (see continue_background), 
+            None to label the whole frame
+    """
+    reader = frames.open_reader() if private_reader else None
+    try: 
+        if model is not None: 
+            continue_background(model, frames, x1, reader=reader)
+        for frame_idx, result, image in frames.iter_frames(range(x1, x2+1), reader=reader):
+            mask = None
+            if (model is not None) and result: # NOTE: a frame labeled again (e.g. tuning) keeps its mask
+                mask = model.mask if frame_idx == model.frame_idx else model.foreground(image, frame_idx)
+            q_in.put((image, frame_idx, mask))
+    finally: 
+        if reader is not None: reader.cap.release()
+
+def split_segments(x1, x2, n_segments): 
+    """ split x1..x2 (inclusive) into at most n_segments contiguous (s1, s2) ranges """
+    n_frames = x2 - x1 + 1
+    n_segments = max(1, min(n_segments, n_frames // MIN_SEGMENT_FRAMES))
+    bounds = [x1 + (n_frames*i)//n_segments for i in range(n_segments + 1)]
+    return [(bounds[i], bounds[i+1]-1) for i in range(n_segments)]
  
-def _consumer(q_in, q_out, labeler_func, labeler_kwargs):    
+def batch_frames(image): 
+    """ frames per batch for frames like image, at least 1 """
+    return int(max(1, min(MAX_BATCH_FRAMES, BATCH_BYTES // max(1, image.nbytes))))
+
+def _get_batch(q_in, batch_size): 
+    """ (frame, frame_idx, mask) from q_in: the next one, and up to batch_size (see batch_frames) 
+        of those already waiting; and whether the end of the frames was reached """
+    batch = []
+    while len(batch) < batch_size: 
+        try: 
+            item = q_in.get(block=(len(batch) == 0)) # NOTE: a batch never waits on the decoder
+        except Empty: 
+            break
+        if item[1] is None: 
+            q_in.put((None, None, None)) # the other consumers stop on it too
+            return batch, True
+        batch.append(item)
+        if batch_size > 1: 
+            batch_size = batch_frames(batch[0][0])
+    return batch, False
+
+def _label(batch, labeler_func, labeler_kwargs, batch_func=None, scratch=None): 
+    """ yield (frame_idx, objs) of a batch of (frame, frame_idx, mask), with batch_func if given """
+    if batch_func is not None: 
+        masks = [mask for _, _, mask in batch]
+        objs = batch_func([frame for frame, _, _ in batch], [frame_idx for _, frame_idx, _ in batch], 
+                          fg_masks=None if all(mask is None for mask in masks) else masks, 
+                          scratch=scratch, **labeler_kwargs)
+        yield from objs.items()
+        return None
+    for frame, frame_idx, mask in batch: 
+        fg_kwargs = dict() if mask is None else {"fg_mask": mask}
+        objs_f, _, _ = labeler_func(frame, frame_idx=frame_idx, **fg_kwargs, **labeler_kwargs)
+        yield frame_idx, objs_f
+
+def _consumer(q_in, q_out, labeler_func, labeler_kwargs, offset=None, batch_func=None):    
+    """ label frames from q_in, in batches (see batch_frames) if the labeler has a batch_func
+    """
+    scratch = dict() # NOTE: arrays reused by batch_func for all frames of this thread
+    done = False
+    while not done:
+        batch, done = _get_batch(q_in, MAX_BATCH_FRAMES if batch_func is not None else 1)
+        for frame_idx, objs_f in _label(batch, labeler_func, labeler_kwargs, batch_func=batch_func, scratch=scratch): 
+            objs_f = ObjectTable.from_objects(objs_f)
+            if offset is not None: objs_f.offset(*offset)
+            q_out.put((frame_idx, objs_f))
+
+class FrameRing(): 
+    """ Fixed-size frame slots in shared memory, handed to labeler processes by index
+
+    Parameters:
+    ----------
+        n_slots (int): frames in flight
+        shape (tuple), dtype: of every frame
     """
+    def __init__(self, n_slots, shape, dtype): 
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slot_bytes = int(np.prod(self.shape))*self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, n_slots*self.slot_bytes))
+        self.free = Queue()
+        for slot in range(n_slots): self.free.put(slot)
+
+    def fits(self, image): return (image.shape == self.shape) & (image.dtype == self.dtype)
+
+    def put(self, image): 
+        """ copy image to a free slot, blocking until one is released """
+        slot = self.free.get()
+        slot_view(self.shm, slot, self.shape, self.dtype)[...] = image
+        return slot
+
+    def write(self, slot, image): 
+        """ copy image to slot, e.g. the mask of a frame put in another ring """
+        slot_view(self.shm, slot, self.shape, self.dtype)[...] = image
+
+    def release(self, slot): self.free.put(slot)
+
+    def close(self): 
+        self.shm.close()
+        self.shm.unlink()
+
+def slot_view(shm, slot, shape, dtype): 
+    dtype = np.dtype(dtype)
+    offset = slot*int(np.prod(shape))*dtype.itemsize
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+
+_process_state = dict() # per labeler process, set by _init_process
+
+def _init_process(shm_name, shape, dtype, labeler_func, labeler_kwargs, offset, mask_shm_name=None, batch_func=None): 
+    _process_state["shm"] = shared_memory.SharedMemory(name=shm_name)
+    _process_state["frame"] = (tuple(shape), dtype)
+    _process_state["labeler"] = (labeler_func, labeler_kwargs, offset, batch_func)
+    _process_state["scratch"] = dict() # NOTE: arrays reused by batch_func for all frames of this process
+    _process_state["mask_shm"] = None if mask_shm_name is None else shared_memory.SharedMemory(name=mask_shm_name)
+
+def _label_slot(slot, frame_idx, image=None, mask=None): 
+    """ label the frame (and mask) in a ring slot, or image if it did not fit the ring, in a labeler process """
+    labeler_func, labeler_kwargs, offset, batch_func = _process_state["labeler"]
+    if image is None: 
+        image = slot_view(_process_state["shm"], slot, *_process_state["frame"])
+        if _process_state["mask_shm"] is not None: 
+            mask = slot_view(_process_state["mask_shm"], slot, _process_state["frame"][0][:2], np.uint8)
+    (_, objs_f), = _label([(image, frame_idx, mask)], labeler_func, labeler_kwargs, batch_func=batch_func, 
+                          scratch=_process_state["scratch"])
+    objs_f = ObjectTable.from_objects(objs_f)
+    if offset is not None: objs_f.offset(*offset)
+    return frame_idx, objs_f # NOTE: pickled, which copies any views of the slot
+
+def _dispatcher(q_in, q_out, n_workers, labeler_func, labeler_kwargs, offset=None, batch_func=None): 
+    """ pass frames from q_in to a pool of labeler processes through a FrameRing 
+    
+    If the pool breaks (e.g. a labeler process is killed), the remaining frames 
+        are drained from q_in and returned without objects, so the producers 
+        and _monitor finish.
     """
-    while True:
-        frame, frame_idx = q_in.get() 
-        if frame_idx is None: 
-            q_in.put((None, None)) 
-            return   
-        objs_f, _, _ = labeler_func(frame, frame_idx=frame_idx, **labeler_kwargs)
-        q_out.put((frame_idx, objs_f))
+    ring, mask_ring, pool = None, None, None
+    broken = False
+    try: 
+        while True: 
+            frame, frame_idx, mask = q_in.get()
+            if frame_idx is None: 
+                return None
+            if broken: 
+                q_out.put((frame_idx, ObjectTable([], dict())))
+                continue
+            slot = None
+            try: 
+                if ring is None: # NOTE: frame shape is known once the first frame is decoded
+                    ring = FrameRing(RING_SLOTS_PER_WORKER*n_workers, frame.shape, frame.dtype)
+                    if mask is not None: # foreground masks share the slot index of their frame
+                        mask_ring = FrameRing(RING_SLOTS_PER_WORKER*n_workers, frame.shape[:2], np.uint8)
+                    pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"), 
+                                               initializer=_init_process, 
+                                               initargs=(ring.shm.name, ring.shape, ring.dtype.str, labeler_func, labeler_kwargs, offset, 
+                                                         None if mask_ring is None else mask_ring.shm.name, batch_func))
+                if ring.fits(frame) & ((mask is None) == (mask_ring is None)): 
+                    slot = ring.put(frame)
+                    if mask is not None: mask_ring.write(slot, mask)
+                    future = pool.submit(_label_slot, slot, frame_idx)
+                else: 
+                    future = pool.submit(_label_slot, None, frame_idx, frame, mask)
+            except Exception as e: # NOTE: e.g. BrokenProcessPool, raised by submit once a process died
+                print(f"labeler processes stopped at frame {frame_idx}, remaining frames are not labeled: {e!r}", error=True)
+                if slot is not None: ring.release(slot)
+                broken = True
+                q_out.put((frame_idx, ObjectTable([], dict())))
+                continue
+            future.add_done_callback(lambda f, slot=slot, frame_idx=frame_idx: _collect(f, slot, frame_idx, ring, q_out))
+    finally: 
+        if pool is not None: pool.shutdown(wait=True)
+        if ring is not None: ring.close()
+        if mask_ring is not None: mask_ring.close()
+
+def _collect(future, slot, frame_idx, ring, q_out): 
+    if slot is not None: ring.release(slot)
+    try: 
+        frame_idx, objs_f = future.result()
+    except Exception as e: 
+        print(f"frame {frame_idx} not labeled: {e}", error=True)
+        objs_f = ObjectTable([], dict())
+    q_out.put((frame_idx, objs_f))
 
 def _monitor(q_out, n_frames, objs): 
     
@@ -59,22 +330,69 @@ def _monitor(q_out, n_frames, objs):
             progress.update(task, advance=1)
             objs[frame_idx] = objs_f
     
-def run_labeler(cap, x1, x2, n_threads, labeler_func, labeler_kwargs): 
-    """ """   
+def run_labeler(frames, x1, x2, n_threads, labeler_func, labeler_kwargs, n_decoders=1, backend="thread", background=None, 
+                batch_func=None): 
+    """ 
+    Parameters:
+    --------
+        n_threads (int): labeler threads, or processes with backend "process"
+        n_decoders (int): decode contiguous segments of x1..x2 in parallel, each
+            segment with its own cv2.VideoCapture on frames.source. 1 with a 
+            background, so one model sees every frame in order and the objects 
+            do not depend on n_decoders
+        backend (str): "thread" or "process". Processes are not serialized by 
+            the GIL in the NumPy/Python parts of the labeler; frames are passed 
+            through shared memory (see FrameRing) and objects returned as 
+            ObjectTables. labeler_func must be importable (picklable).
+        background (dict or BackgroundModel): BackgroundModel kwargs, or a model 
+            kept by the caller so the next call continues it (see continue_background). 
+            The labeler is passed the foreground mask of each frame (fg_mask) and 
+            skips the static background. None to label whole frames.
+        batch_func (function): labeler entry point for a stack of frames (e.g. 
+            edge_gradient.labeler_batch), called with (frames, frame_idxs, fg_masks, 
+            scratch, **labeler_kwargs). Threads take frames in batches (see 
+            batch_frames), processes one ring slot at a time; each keeps its 
+            scratch arrays for all of its frames.
+    """   
+    if backend not in BACKENDS: 
+        print(f"backend {backend} not in {BACKENDS}, using thread", warning=True)
+        backend = "thread"
+    if isinstance(background, dict): 
+        background = BackgroundModel(**background)
     n_frames = x2 - x1 + 1
     q_in = Queue(maxsize=100)
     q_out = Queue()
 
-    for i in range(n_threads):
-        worker = Thread(target=_consumer, args=(q_in, q_out, labeler_func, labeler_kwargs))
-        worker.setDaemon(True)
-        worker.start()
+    offset = None if frames.roi is None else frames.roi[:2] # objects are returned in full-frame coordinates
+    if backend == "process": 
+        dispatcher = Thread(target=_dispatcher, args=(q_in, q_out, n_threads, labeler_func, labeler_kwargs, offset, batch_func))
+        dispatcher.setDaemon(True)
+        dispatcher.start()
+    else: 
+        for i in range(n_threads):
+            worker = Thread(target=_consumer, args=(q_in, q_out, labeler_func, labeler_kwargs, offset, batch_func))
+            worker.setDaemon(True)
+            worker.start()
     objs = dict()
     mon = Thread(target=_monitor, args=(q_out, n_frames, objs))
     mon.start()
-    producer = Thread(target=_producer, args=(q_in, cap, x1, x2))
-    producer.start()
-    producer.join()
+    if (n_decoders > 1) & (background is not None): 
+        print(f"background model on, decoding with 1 decoder instead of {n_decoders}", warning=True)
+    if (n_decoders > 1) & (frames.source is not None) & (background is None): 
+        segments = split_segments(x1, x2, n_decoders)
+    else: 
+        segments = [(x1, x2)]
+    private_reader = (len(segments) > 1) & (not frames.zero_copy)
+
+    producers = []
+    for s1, s2 in segments: 
+        producer = Thread(target=_producer, args=(q_in, frames, s1, s2, private_reader, background))
+        producer.start()
+        producers.append(producer)
+    for producer in producers: 
+        producer.join()
+    q_in.put((None, None, None))
     mon.join()
+    if backend == "process": dispatcher.join()
     print('Labeler done')
     return objs
@@ -16,9 +16,17 @@ Identify objects that have a "crisp" outline (i.e. above a threshold in the grad
 
 """
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import zlib
+
 import numpy as np
 import cv2
 
+from ...objects import ObjectTable, ragged_column
+from ...morphology import fit_axes
+
 params = {
     "name": "kwargs", 
     "title": "Parameters",
@@ -33,9 +41,13 @@ params = {
         {"name": "area_min_px", "title": "Min. size (px)", "type":  "int", "value": 5},
         {"name": "cal_axis_length", "title": "Cal. axis length", "type":  "bool", "value": False, "visible": False},
         {"name": "add_images", "title": "Add obj. images", "type":  "bool", "value": False, "visible": False},
+        {"name": "n_tiles", "title": "Tiles (large frames)", "type":  "int", "limits": [1, 64], "value": 1},
+        {"name": "centroids_only", "title": "Centroids only (fast)", "type":  "bool", "value": False},
     ]
 }
 
+STAGE_CACHE = True # labeler takes stage_cache (see handler.NODE_EXTRAS)
+
 def setup(): return None
 
 def labeler(src, 
@@ -51,6 +63,11 @@ def labeler(src,
     clear_edge_filter:bool=True,
     frame_idx:int=None,
     add_obj_images:bool=False, 
+    n_tiles:int=1,
+    fg_mask:np.ndarray=None,
+    centroids_only:bool=False,
+    stage_cache:bool=False,
+    scratch:dict=None,
     return_objects:bool=True,
     return_thresh:bool=False,
     return_labels:bool=False,
@@ -70,55 +87,70 @@ def labeler(src,
         cal_axis_length:bool=False,
         clear_edge_filter:bool=True,
         frame_idx:int=None
+        n_tiles:int=1, label row tiles of the frame concurrently (see label_tiles)
+        fg_mask:np.ndarray=None, only label objects in the foreground (non-zero), e.g. 
+            from labeler_worker.BackgroundModel
+        centroids_only:bool=False, objects without contours (nor axes), only the columns 
+            of connectedComponentsWithStats; contours of tracked objects are traced 
+            later (see trace_contours)
+        stage_cache:bool=False, keep the stage outputs of this frame (see StageCache) so 
+            a call with other filter parameters only runs the stages after the change
+        scratch:dict=None, arrays reused as the gray, blur, threshold and label images 
+            of each call (see labeler_batch); the thresh and labels returned are 
+            overwritten by the next call with the same scratch
         return_objects:bool=True
         return_thresh:bool=False
         return_labels:bool=False
     Returns: 
     ----------
-        objs (dict) 
+        objs (safas.objects.ObjectTable): read like a dict of object dicts
     """
+    if stage_cache | add_obj_images: # NOTE: cached outputs and object images must outlive the call
+        scratch = None
     if src.ndim == 3: 
-        src = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY)
-
-    if apply_blur: 
-        src = cv2.GaussianBlur(
-            src, 
-            (blur_kernel_size, blur_kernel_size), 
-            0
-        )
-    
-    if brightfield: # thresh_inv = True is brightfield, ie the objects are darker than the field
-        ret, thresh = cv2.threshold(src, thresh_val, 255, cv2.THRESH_BINARY)
-    else: 
-        ret, thresh = cv2.threshold(src, thresh_val, 255, cv2.THRESH_BINARY_INV)
-
-    _, labels, stats, centroids = cv2.connectedComponentsWithStats(thresh, 4, cv2.CV_32S)
+        src = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY, dst=scratch_buffer(scratch, "gray", src.shape[:2]))
+    stages = frame_stages.frame(src, frame_idx) if stage_cache else dict()
+
+    # stages, each keyed by its parameters and those of the stages before it (only kept with stage_cache)
+    img = src
+    key = ("blur", apply_blur, blur_kernel_size) if stage_cache else None
+    src = run_stage(stages, "blur", key, lambda: blur(img, apply_blur, blur_kernel_size, 
+                                                      dst=scratch_buffer(scratch, "blur", img.shape)))
+    if stage_cache: 
+        key += ("threshold", brightfield, thresh_val, image_digest(fg_mask))
+    thresh = run_stage(stages, "threshold", key, lambda: threshold(src, thresh_val, brightfield, fg_mask=fg_mask, 
+                                                                   dst=scratch_buffer(scratch, "thresh", src.shape)))
+    if stage_cache: 
+        key += ("components", n_tiles)
+    comps = run_stage(stages, "components", key, lambda: components(src, thresh, n_tiles, cal_grad=apply_grad_filter, 
+                                                                    labels=scratch_buffer(scratch, "labels", src.shape, np.int32)))
+    n_labels, stats, centroids = comps["n_labels"], comps["stats"], comps["centroids"]
     
     if not return_thresh: # NOTE: removes from memory - rel. for multiprocessing 
         del thresh
         thresh = None
 
-    obj_idxs, coords = labels_to_coords(labels) # get coords of each label in the image
-    
     area = stats[:, 4]
     bbox = stats[:,:4]
 
-    if clear_edge_filter: 
-        obj_idxs_fill = objs_on_edge(labels)
-        labels = fill_coords(labels, coords, obj_idxs_fill)
-        obj_idxs = np.setdiff1d(obj_idxs, obj_idxs_fill)
+    keep = np.ones(n_labels, dtype=bool) # filters reject objects by label 
+    keep[0] = False # background
 
-    if apply_grad_filter: 
-        grad = cal_grad_img(src, grad_thresh_val=grad_thresh_val)
-        obj_idxs, grad_counts = np.unique(labels[grad>0], return_counts=True)
-        del grad
-        obj_idxs_fill = np.setdiff1d(np.unique(labels), obj_idxs)
-        labels = fill_coords(labels, coords, obj_idxs_fill)
+    if clear_edge_filter: 
+        keep[comps["on_edge"]] = False
 
     if apply_min_px_filter: 
-        obj_idxs_fill = np.intersect1d(np.argwhere(area < area_min_px).ravel(), obj_idxs)
-        obj_idxs = np.setdiff1d(obj_idxs, obj_idxs_fill)
-        labels = fill_coords(labels, coords, obj_idxs_fill)
+        keep &= area >= area_min_px
+
+    if apply_grad_filter: # NOTE: after the other filters, gradients are only needed for candidates
+        grad_max = label_gradients(comps, src, np.flatnonzero(keep))
+        keep &= grad_max > grad_thresh_val
+
+    obj_idxs = np.flatnonzero(keep)
+    if centroids_only & (not return_labels) & (not add_obj_images): 
+        labels = None # NOTE: the label image of the objects kept is only needed for contours
+    else: 
+        labels = kept_labels(comps, keep, copy=stage_cache)
 
     # format outputs
     if return_objects: 
@@ -127,12 +159,14 @@ def labeler(src,
             bbox=bbox, 
             area=area, 
             centroids=centroids, 
-            coords=coords,
+            coords=None,
             labels=labels, 
             src=src, 
             cal_axis_length=cal_axis_length,
             add_obj_images=add_obj_images,
-            frame_idx=frame_idx
+            frame_idx=frame_idx, 
+            contours=None if centroids_only else label_contours(comps, labels, obj_idxs, bbox), 
+            centroids_only=centroids_only
         )
     else: 
         objs = None
@@ -141,8 +175,290 @@ def labeler(src,
     
     return (objs, thresh, labels)
 
-def cal_grad_img(img, grad_thresh_val=30):
-    """ calculate the gradient image in two directions """
+def labeler_batch(frames, frame_idxs, fg_masks=None, scratch=None, **kwargs): 
+    """ Label a stack of frames, reusing one set of scratch arrays (see labeler) for all of them
+
+    Parameters: 
+    ----------
+        frames (array or list): N x H x W (x C) frames
+        frame_idxs (list): index of each frame
+        fg_masks (list): foreground mask of each frame (see labeler), or None
+        scratch (dict): scratch arrays kept by the caller across batches, None for a new set
+        **kwargs: labeler kwargs
+    Returns: 
+    ----------
+        objs (dict): frame_idx: ObjectTable
+    """
+    scratch = dict() if scratch is None else scratch
+    objs = dict()
+    for i, (frame, frame_idx) in enumerate(zip(frames, frame_idxs)): 
+        fg_mask = None if fg_masks is None else fg_masks[i]
+        objs[frame_idx], _, _ = labeler(frame, frame_idx=frame_idx, fg_mask=fg_mask, scratch=scratch, **kwargs)
+    return objs
+
+def scratch_buffer(scratch, name, shape, dtype=np.uint8): 
+    """ array name of scratch (dict), allocated on first use or when the shape changes, None without scratch """
+    if scratch is None: 
+        return None
+    buffer = scratch.get(name)
+    if (buffer is None) or (buffer.shape != tuple(shape)) or (buffer.dtype != dtype): 
+        buffer = scratch[name] = np.empty(shape, dtype=dtype)
+    return buffer
+
+STAGE_CACHE_FRAMES = 2 # frames whose stage outputs are kept, e.g. the frame shown while tuning
+
+class StageCache(): 
+    """ Stage outputs of the last frames labeled with stage_cache=True
+
+    Each frame holds stage: (key, output), where the key chains the parameters
+        of the stage and of the stages before it. A stage whose key matches is
+        not run again, so changing a filter parameter reuses blur, threshold and
+        connected components, and contours already traced. Frames are 
+        identified by frame_idx, shape and a checksum of the pixels.
+
+    NOTE: cached outputs are shared between calls and must not be modified in place
+    """
+    def __init__(self, max_frames=STAGE_CACHE_FRAMES): 
+        self.max_frames = max_frames
+        self._frames = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self): return len(self._frames)
+
+    def frame(self, img, frame_idx=None): 
+        """ stages (dict) of img, empty for a new frame """
+        key = (frame_idx, img.shape, image_digest(img))
+        with self._lock: 
+            stages = self._frames.pop(key, dict())
+            self._frames[key] = stages
+            while len(self._frames) > self.max_frames: # evict least recently used
+                self._frames.popitem(last=False)
+        return stages
+
+    def clear(self): 
+        with self._lock: 
+            self._frames = OrderedDict()
+
+frame_stages = StageCache()
+
+def image_digest(img): 
+    """ checksum of the pixels of img, None if img is None """
+    if img is None: 
+        return None
+    return zlib.crc32(np.ascontiguousarray(img).data)
+
+def run_stage(stages, name, key, func): 
+    """ output of stage name, from stages if it was run with the same key """
+    cached = stages.get(name)
+    if (cached is not None) and (cached[0] == key): 
+        return cached[1]
+    out = func()
+    stages[name] = (key, out)
+    return out
+
+def blur(src, apply_blur, blur_kernel_size, dst=None): 
+    if apply_blur: 
+        src = cv2.GaussianBlur(
+            src, 
+            (blur_kernel_size, blur_kernel_size), 
+            0, 
+            dst=dst
+        )
+    return src
+
+def threshold(src, thresh_val, brightfield, fg_mask=None, dst=None): 
+    """ binary image of the objects, within fg_mask if given """
+    if brightfield: # thresh_inv = True is brightfield, ie the objects are darker than the field
+        ret, thresh = cv2.threshold(src, thresh_val, 255, cv2.THRESH_BINARY, dst=dst)
+    else: 
+        ret, thresh = cv2.threshold(src, thresh_val, 255, cv2.THRESH_BINARY_INV, dst=dst)
+    if fg_mask is not None: 
+        thresh[fg_mask == 0] = 0 # NOTE: static blobs never reach the connected components
+    return thresh
+
+def components(src, thresh, n_tiles=1, cal_grad=True, labels=None): 
+    """ Connected components of thresh, whole frame or in row tiles (see label_tiles)
+
+    labels (array): int32 array the whole-frame label image is written to, None to allocate one
+
+    Returns:
+    ----------
+        comps (dict): n_labels, stats, centroids, on_edge (labels), labels (whole frame) 
+            or tiles, grad_max and grad_done (per label, see label_gradients) and 
+            contours (obj_idx: contour, see label_contours)
+    """
+    bounds = tile_bounds(thresh.shape[0], n_tiles)
+    if len(bounds) > 1: 
+        with ThreadPoolExecutor(max_workers=len(bounds)) as pool: # NOTE: cv2 and most of numpy release the GIL
+            comps = label_tiles(src, thresh, bounds, pool, cal_grad=cal_grad)
+    else: 
+        if labels is None: 
+            n_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(thresh, 4, cv2.CV_32S)
+        else: # NOTE: 4 above is taken as the labels argument, the connectivity is the default 8
+            n_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(thresh, labels=labels, connectivity=8, 
+                                                                                  ltype=cv2.CV_32S)
+        comps = {"n_labels": n_labels, "labels": labels, "stats": stats, "centroids": centroids, 
+                 "on_edge": objs_on_edge(labels), "grad_max": None}
+    
+    if comps["grad_max"] is None: 
+        comps["grad_max"] = np.zeros(comps["n_labels"], dtype=np.uint8)
+        comps["grad_done"] = np.zeros(comps["n_labels"], dtype=bool)
+    else: 
+        comps["grad_done"] = np.ones(comps["n_labels"], dtype=bool)
+    comps["contours"] = dict()
+    return comps
+
+def kept_labels(comps, keep, copy=True): 
+    """ label image of the objects in keep (bool, per label) """
+    if "tiles" in comps: 
+        return paint_tiles(comps, keep)
+    return relabel(comps["labels"], keep, out=None if copy else comps["labels"])
+
+def label_gradients(comps, src, obj_idxs): 
+    """ maximum edge gradient per label, computed for the obj_idxs not done yet """
+    grad_max, grad_done = comps["grad_max"], comps["grad_done"]
+    todo = obj_idxs[~grad_done[obj_idxs]]
+    if len(todo) > 0: 
+        labels = comps["labels"] if "labels" in comps else kept_labels(comps, np.ones(comps["n_labels"], dtype=bool))
+        grad = grad_max_by_label(src, labels, comps["n_labels"], bbox=comps["stats"][:, :4], obj_idxs=todo)
+        grad_max[todo] = grad[todo]
+        grad_done[todo] = True
+    return grad_max
+
+def label_contours(comps, labels, obj_idxs, bbox): 
+    """ contours of obj_idxs (see object_contours), tracing only those not traced yet """
+    contours = comps["contours"]
+    todo = np.array([obj_idx for obj_idx in obj_idxs if obj_idx not in contours], dtype=int)
+    if len(todo) == len(obj_idxs): 
+        contours.update(object_contours(labels, obj_idxs, bbox))
+    elif len(todo) > 0: 
+        keep = np.zeros(comps["n_labels"], dtype=bool)
+        keep[todo] = True
+        contours.update(object_contours(kept_labels(comps, keep), todo, bbox))
+    return {obj_idx: contours[obj_idx] for obj_idx in obj_idxs if obj_idx in contours}
+
+MIN_TILE_ROWS = 64
+
+def tile_bounds(height, n_tiles): 
+    """ (y0, y1) of at most n_tiles row tiles, each at least MIN_TILE_ROWS high
+
+    NOTE: tiles start on even rows, cv2 labels 8-connected components in 2x2 blocks 
+        and numbers them in the order of the blocks
+    """
+    n_tiles = max(1, min(int(n_tiles), height // MIN_TILE_ROWS))
+    rows = [2*((height*i)//(2*n_tiles)) for i in range(n_tiles)] + [height]
+    return [(rows[i], rows[i+1]) for i in range(n_tiles)]
+
+def _label_tile(src, thresh, y0, y1, cal_grad): 
+    """ connected components of rows y0:y1, gradients with the row above and below 
+        that the Sobel kernel needs, so pixels match the whole-frame result """
+    n_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(thresh[y0:y1], 4, cv2.CV_32S)
+
+    on_edge = [labels[:, 0], labels[:, -1]]
+    if y0 == 0: on_edge.append(labels[0])
+    if y1 == thresh.shape[0]: on_edge.append(labels[-1])
+    on_edge = np.unique(np.hstack(on_edge))
+
+    grad_max = None
+    if cal_grad: 
+        ya, yb = max(0, y0 - 1), min(src.shape[0], y1 + 1)
+        grad_max = label_max(cal_grad_mag(src[ya:yb])[(y0 - ya):(y1 - ya)], labels, n_labels)
+    return {"n_labels": n_labels, "labels": labels, "stats": stats, "centroids": centroids, 
+            "on_edge": on_edge, "grad_max": grad_max}
+
+def label_tiles(src, thresh, bounds, pool, cal_grad=True): 
+    """ Label row tiles of thresh concurrently and merge objects across the tile seams
+
+    Objects touching across a seam (8-connected, as cv2.connectedComponentsWithStats 
+        is called here) are joined with a union-find over 
+        the tile labels. Merged labels are numbered by their first pixel in raster 
+        order, so n_labels, stats and centroids match cv2.connectedComponentsWithStats 
+        on the whole frame.
+
+    Returns:
+    ----------
+        tiles (dict): n_labels, stats, centroids, on_edge (labels), grad_max (per label) 
+            of the frame, and the tiles for paint_tiles
+    """
+    tiles = list(pool.map(lambda b: _label_tile(src, thresh, *b, cal_grad), bounds))
+    n_fg = [t["n_labels"] - 1 for t in tiles] # global label of tile label l > 0 is offset + l
+    offsets = np.concatenate([[0], np.cumsum(n_fg)[:-1]])
+    parent = np.arange(1 + sum(n_fg))
+    
+    def find(i): 
+        while parent[i] != i: 
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for t in range(len(tiles) - 1): # join labels touching across the seam below tile t
+        a, b = tiles[t]["labels"][-1], tiles[t+1]["labels"][0]
+        pairs = []
+        for a_s, b_s in [(a, b), (a[:-1], b[1:]), (a[1:], b[:-1])]: # NOTE: 8-connected, including diagonals
+            touch = (a_s > 0) & (b_s > 0)
+            pairs.append(np.stack([a_s[touch] + offsets[t], b_s[touch] + offsets[t+1]], axis=1))
+        pairs = np.unique(np.concatenate(pairs), axis=0)
+        for i, j in pairs: 
+            ri, rj = find(i), find(j)
+            if ri != rj: parent[max(ri, rj)] = min(ri, rj) # NOTE: the root is the first label in raster order
+    while True: 
+        grand = parent[parent]
+        if (grand == parent).all(): break
+        parent = grand
+    roots = np.flatnonzero(parent == np.arange(len(parent)))
+    final = np.searchsorted(roots, parent) # global label: merged label
+
+    for t, tile in zip(range(len(tiles)), tiles): 
+        tile["lut"] = np.concatenate([[0], final[offsets[t] + 1:offsets[t] + tile["n_labels"]]]).astype(np.int32)
+
+    n_labels = len(roots)
+    lbl = np.concatenate([tile["lut"] for tile in tiles])
+    stats = np.concatenate([tile["stats"] for tile in tiles]).astype(np.int64)
+    ys = np.concatenate([np.full(tile["n_labels"], y0) for tile, (y0, y1) in zip(tiles, bounds)])
+    cents = np.concatenate([tile["centroids"] for tile in tiles])
+    area = np.bincount(lbl, weights=stats[:, 4], minlength=n_labels)
+    
+    x0, y_0 = np.full(n_labels, thresh.shape[1]), np.full(n_labels, thresh.shape[0])
+    x1, y_1 = np.zeros(n_labels, dtype=np.int64), np.zeros(n_labels, dtype=np.int64)
+    fg = stats[:, 4] > 0 # NOTE: a tile without background still has a (0 px) label 0
+    np.minimum.at(x0, lbl[fg], stats[fg, 0])
+    np.minimum.at(y_0, lbl[fg], stats[fg, 1] + ys[fg])
+    np.maximum.at(x1, lbl[fg], stats[fg, 0] + stats[fg, 2])
+    np.maximum.at(y_1, lbl[fg], stats[fg, 1] + stats[fg, 3] + ys[fg])
+    
+    cents = np.where(fg[:, None], cents, 0)
+    sum_x = np.bincount(lbl, weights=np.rint(cents[:, 0]*stats[:, 4]), minlength=n_labels) # pixel coordinate sums
+    sum_y = np.bincount(lbl, weights=np.rint((cents[:, 1] + ys)*stats[:, 4]), minlength=n_labels)
+    with np.errstate(invalid="ignore", divide="ignore"): 
+        centroids = np.stack([sum_x/area, sum_y/area], axis=1)
+    stats = np.stack([x0, y_0, x1 - x0, y_1 - y_0, area], axis=1).astype(np.int32)
+
+    if cal_grad: 
+        grad_max = np.zeros(n_labels, dtype=np.uint8)
+        np.maximum.at(grad_max, lbl, np.concatenate([tile["grad_max"] for tile in tiles]))
+    else: 
+        grad_max = None
+
+    return {"n_labels": n_labels, "stats": stats, "centroids": centroids, 
+            "on_edge": np.unique(np.concatenate([tile["lut"][tile["on_edge"]] for tile in tiles])), 
+            "grad_max": grad_max, "tiles": tiles, "bounds": bounds}
+
+def paint_tiles(tiles, keep): 
+    """ whole-frame label image of the objects kept, one lookup per tile """
+    shape = (tiles["bounds"][-1][1], tiles["tiles"][0]["labels"].shape[1])
+    labels = np.empty(shape, dtype=np.int32)
+    def paint(tile, y0, y1): 
+        lut = np.where(keep[tile["lut"]], tile["lut"], 0).astype(np.int32)
+        labels[y0:y1] = lut[tile["labels"]]
+    with ThreadPoolExecutor(max_workers=len(tiles["tiles"])) as pool: 
+        list(pool.map(lambda item: paint(item[0], *item[1]), zip(tiles["tiles"], tiles["bounds"])))
+    return labels
+
+GRAD_BBOX_FRACTION = 0.25 # compute gradients per bbox when candidates cover less of the frame ...
+GRAD_BBOX_OBJ_PX = 5000 # ... counting the cv2 calls of each bbox as this many full-frame pixels
+
+def cal_grad_mag(img):
+    """ gradient magnitude image, mean of abs. Sobel gradients in two directions """
     scale = 1
     delta = 0
     ddepth = cv2.CV_16S
@@ -152,16 +468,61 @@ def cal_grad_img(img, grad_thresh_val=30):
     abs_grad_x = cv2.convertScaleAbs(grad_x)
     abs_grad_y = cv2.convertScaleAbs(grad_y)
 
-    grad = cv2.addWeighted(abs_grad_x, 0.5, abs_grad_y, 0.5, 0)
+    return cv2.addWeighted(abs_grad_x, 0.5, abs_grad_y, 0.5, 0)
+
+def cal_grad_img(img, grad_thresh_val=30):
+    """ calculate the gradient image in two directions """
+    grad = cal_grad_mag(img)
     N, filt = cv2.threshold(grad, grad_thresh_val, 255, cv2.THRESH_BINARY)
     return filt
 
+def label_max(values, labels, n_labels): 
+    """ maximum of values over the pixels of each label, 0 for labels without pixels """
+    fg = labels > 0
+    out = np.zeros(n_labels, dtype=values.dtype)
+    np.maximum.at(out, labels[fg], values[fg])
+    return out
+
+def grad_max_by_label(src, labels, n_labels, bbox=None, obj_idxs=None): 
+    """ Maximum edge gradient (see cal_grad_mag) of each label
+
+    If there are few obj_idxs and their bboxes cover a small part of the frame, 
+        gradients are only computed within each bbox (padded by the 1 px Sobel 
+        kernel radius), otherwise once over the full frame, e.g. for dense frames 
+        of many small objects. Labels not in obj_idxs are 0.
+    """
+    if (bbox is None) | (obj_idxs is None): 
+        return label_max(cal_grad_mag(src), labels, n_labels)
+    
+    h_img, w_img = labels.shape
+    x0 = np.clip(bbox[obj_idxs, 0] - 1, 0, w_img)
+    y0 = np.clip(bbox[obj_idxs, 1] - 1, 0, h_img)
+    x1 = np.clip(bbox[obj_idxs, 0] + bbox[obj_idxs, 2] + 1, 0, w_img)
+    y1 = np.clip(bbox[obj_idxs, 1] + bbox[obj_idxs, 3] + 1, 0, h_img)
+    
+    covered = ((x1 - x0)*(y1 - y0)).sum() + len(obj_idxs)*GRAD_BBOX_OBJ_PX*GRAD_BBOX_FRACTION
+    if covered > GRAD_BBOX_FRACTION*labels.size: 
+        grad_max = label_max(cal_grad_mag(src), labels, n_labels)
+        return np.where(np.isin(np.arange(n_labels), obj_idxs), grad_max, 0)
+
+    grad_max = np.zeros(n_labels, dtype=np.uint8)
+    for i, obj_idx in enumerate(obj_idxs): # NOTE: a pixel's gradient only depends on its 3x3 neighbourhood
+        grad = cal_grad_mag(src[y0[i]:y1[i], x0[i]:x1[i]])
+        in_obj = labels[y0[i]:y1[i], x0[i]:x1[i]] == obj_idx
+        if in_obj.any(): grad_max[obj_idx] = grad[in_obj].max()
+    return grad_max
+
 def objs_on_edge(labels):
     """ clear objects touching edge """
     x  = labels[[0, labels.shape[0]-1], :] # NOTE: no -1 index in cython
     y = labels[:, [0, labels.shape[1]-1]]
     return np.unique(np.hstack([x.ravel(),y.ravel()]))
 
+def relabel(labels, keep, out=None): 
+    """ set rejected objects to background with one lookup of keep (bool, per label), in place if out is labels """
+    lut = np.where(keep, np.arange(len(keep)), 0).astype(labels.dtype)
+    return np.take(lut, labels, out=out, mode="clip") # NOTE: labels are < len(keep), clip avoids a buffered copy
+
 def fill_coords(labels, coords, obj_idxs): 
     if len(obj_idxs)==0: # i.e. nothing to fill
         return labels
@@ -183,6 +544,7 @@ def compare_idxs_lbls(labels, obj_idxs, disp=False):
 def labels_to_coords(x): 
     """  
     Return list that contains indices of each  unique values in x
+    NOTE: sorts every pixel, only build coordinates on request (not used by labeler)
     ----------
         x (np.array): Array with arbitrary dimensions
     Returns
@@ -197,6 +559,37 @@ def labels_to_coords(x):
     ix_ndim = np.c_[ix_ndim] if x.ndim > 1 else ix_flat
     return u, np.split(ix_ndim, ix_u[1:])
 
+def object_contours(labels, obj_idxs, bbox): 
+    """ Largest external contour of each object, from one pass over the label image
+
+    Objects touching only diagonally share one contour in the pass over the 
+        binary image; those that end up without a contour are traced one by one 
+        within their bbox.
+
+    Returns: 
+    ----------
+        contours (dict): obj_idx: [contour] in cv2 format, full-frame coordinates
+    """
+    mask = (labels > 0).astype(np.uint8)
+    contours_all, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contours = dict()
+    
+    if len(contours_all) > 0: 
+        first = np.array([c[0, 0] for c in contours_all]) # first point is on the object boundary
+        lbls = labels[first[:, 1], first[:, 0]]
+        lens = np.array([len(c) for c in contours_all])
+        order = np.lexsort((lens, lbls)) # by label, then length
+        last = np.r_[lbls[order][1:] != lbls[order][:-1], True] # longest contour per label
+        contours = {lbls[i]: [contours_all[i]] for i in order[last]}
+
+    for obj_idx in np.setdiff1d(obj_idxs, list(contours)): 
+        x, y, w, h = bbox[obj_idx]
+        mask = (labels[y:(y+h), x:(x+w)] == obj_idx).astype(np.uint8)
+        contours_i, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(int(x), int(y)))
+        if len(contours_i) > 0: 
+            contours[obj_idx] = [max(contours_i, key=len)]
+    return contours
+
 def format_output_objects(obj_idxs, 
                           bbox, 
                           area, 
@@ -206,92 +599,106 @@ def format_output_objects(obj_idxs,
                           src=None, 
                           cal_axis_length=False,
                           add_obj_images=False,
-                          frame_idx=None): 
+                          frame_idx=None, 
+                          contours=None, 
+                          centroids_only=False): 
     """ Format object output for handling in Tracker and ViewerWindow
-    """
-    objs = dict()
-    
-    obj_idx_l = 1
 
-    diffs = compare_idxs_lbls(labels, obj_idxs, disp=False)
-    
-    if len(diffs) > 0: 
-        print(f"FORMAT OBJS obj_idxs diffs: {obj_idxs}", warning=True)
- 
-    for ix, obj_idx in enumerate(obj_idxs): 
-        if obj_idx == 0: 
-            continue # exclude 0 object (background)
-        if area[obj_idx] == 0: 
-            continue
+    Contours come from one pass over labels (see object_contours), area, centroid
+        and bbox from the connectedComponentsWithStats arrays, all kept as columns
+        of an ObjectTable (keys 1..n).
+    """
+    obj_idxs = np.asarray(obj_idxs, dtype=int)
+    obj_idxs = obj_idxs[obj_idxs != 0] # exclude 0 object (background)
+    obj_idxs = obj_idxs[area[obj_idxs] > 0]
+    if centroids_only: # NOTE: contours are traced for tracked objects only (see trace_contours)
+        contour_col = ("const", None)
+        cal_axis_length = False
+    else: 
+        if contours is None: 
+            contours = object_contours(labels, obj_idxs, bbox)
+        contours_coor = [contours[obj_idx][0].reshape(-1, 2) if obj_idx in contours else None for obj_idx in obj_idxs]
+        contour_col = ragged_column(contours_coor)
+
+    if cal_axis_length: # much faster to only calculate these for objects in tracks
+        axes = np.array([fit_axes(contour, bbox[obj_idx]) for obj_idx, contour in zip(obj_idxs, contours_coor)], 
+                        dtype=float).reshape(-1, 2)
+        axes_cols = {"obj_major_axis": ("numbers", axes[:, 0]), "obj_minor_axis": ("numbers", axes[:, 1])}
+    else: 
+        axes_cols = {"obj_major_axis": ("const", None), "obj_minor_axis": ("const", None)}
 
-        x,y,w,h = bbox[obj_idx]
-        mask = labels[y:(y+h), x:(x+w)] > 0 # ,w,h,a
-
-        approx_fun = cv2.CHAIN_APPROX_SIMPLE # | cv2.CHAIN_APPROX_NONE
-        mode = cv2.RETR_EXTERNAL # |  cv2.RETR_LIST
-        contours_i, hierarchy = cv2.findContours((mask*255).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        try: 
-            mx = np.argmax([len(cc) for cc in contours_i])
-            contours_i = [contours_i[mx]]
-        except ValueError: 
-            contours_i = None
-
-        try: 
-            contours_coor = contours_i[0].reshape(-1, 2)
-        except IndexError: 
-            contours_coor = None
-        except TypeError: 
-            contours_coor = None
-
-        if cal_axis_length: # much faster to only calculate these for objects in tracks
-            try: 
-                (xm,ym),(ma,mi),angle = cv2.fitEllipse(contours_coor)
-                major_axis = max(ma,mi)
-                minor_axis = min(ma,mi)
-            except: 
-                major_axis = max(w,h)
-                minor_axis = min(w,h)
-            
-            if not np.isfinite(major_axis): 
-                major_axis = max(w,h)
-            if not np.isfinite(minor_axis): 
-                minor_axis = min(w,h)
-        else: 
-            minor_axis, major_axis = None, None
-
-        if add_obj_images: 
+    if add_obj_images: 
+        obj_imgs, obj_masks = [], []
+        for obj_idx in obj_idxs: 
+            x,y,w,h = bbox[obj_idx]
+            mask = labels[y:(y+h), x:(x+w)] > 0
             pad = 5
             xmin = np.clip(x-pad, a_min=0, a_max=src.shape[0]) 
             xmax = np.clip(x+w+pad, a_min=0, a_max=src.shape[0])
             ymin = np.clip(y-pad, a_min=0, a_max=src.shape[1]) 
             ymax = np.clip(y+h+pad, a_min=0, a_max=src.shape[1])
 
-            obj_img = src[xmin:xmax, ymin:ymax]
-            obj_mask = mask[xmin:xmax, ymin:ymax]
-        else: 
-            obj_img, obj_mask = None, None
-
-        if contours_coor is not None: 
-            contours_coor[:,0] += x
-            contours_coor[:,1] += y
-
-        objs[obj_idx_l] = {
-            "obj_idx": obj_idx, 
-            "track_idx": None, 
-            "frame_idx": frame_idx,
-            "obj_area": area[obj_idx], 
-            "obj_centroid": centroids[obj_idx], 
-            "obj_contour": contours_coor,
-            "obj_contour_cv": contours_i,
-            "obj_bbox": bbox[obj_idx],
-            "obj_major_axis": major_axis,
-            "obj_minor_axis": minor_axis,
-            "obj_img": obj_img,
-            "obj_img_mask": obj_mask,
-            "image_size": src.shape
-        }
-        
-        obj_idx_l += 1 # increment now
-    
-    return objs
\ No newline at end of file
+            obj_imgs.append(src[xmin:xmax, ymin:ymax])
+            obj_masks.append(mask[xmin:xmax, ymin:ymax])
+        img_cols = {"obj_img": ("list", obj_imgs), "obj_img_mask": ("list", obj_masks)}
+    else: 
+        img_cols = {"obj_img": ("const", None), "obj_img_mask": ("const", None)}
+
+    cols = {
+        "obj_idx": ("stack", obj_idxs), 
+        "track_idx": ("const", None), 
+        "frame_idx": ("const", frame_idx),
+        "obj_area": ("stack", area[obj_idxs]), 
+        "obj_centroid": ("stack", centroids[obj_idxs]), 
+        "obj_contour": contour_col, # NOTE: obj_contour_cv is derived from obj_contour
+        "obj_bbox": ("stack", bbox[obj_idxs]),
+        **axes_cols, 
+        **img_cols, 
+        "image_size": ("const", src.shape)
+    }
+    return ObjectTable(np.arange(1, len(obj_idxs) + 1), cols)
+
+def trace_contours(src, bbox, area, 
+                   brightfield=True, 
+                   thresh_val=120, 
+                   apply_blur=True, 
+                   blur_kernel_size=3, 
+                   **kwargs): 
+    """ Contours of objects labeled with centroids_only, traced again within their bbox
+
+    Each bbox, padded by the blur kernel radius so the blur matches the whole 
+        frame, is blurred and thresholded as in labeler. The object is the 
+        component with the same bbox and area; None if there is none (e.g. the 
+        object was cut by a foreground mask).
+
+    Parameters: 
+    ----------
+        src (array): frame the objects were labeled in
+        bbox (array): N x 4 (x, y, w, h) in src coordinates
+        area (array): N areas (px)
+        **kwargs: labeler kwargs
+    Returns: 
+    ----------
+        contours (list): N x 2 contour in src coordinates, or None, per object
+    """
+    if src.ndim == 3: 
+        src = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY)
+    h_img, w_img = src.shape
+    pad = blur_kernel_size//2 if apply_blur else 0
+    contours = []
+    for (x, y, w, h), obj_area in zip(np.asarray(bbox, dtype=int), area): 
+        x0, y0 = max(0, x - pad), max(0, y - pad)
+        x1, y1 = min(w_img, x + w + pad), min(h_img, y + h + pad)
+        thresh = threshold(blur(src[y0:y1, x0:x1], apply_blur, blur_kernel_size), thresh_val, brightfield)
+        thresh = np.ascontiguousarray(thresh[(y - y0):(y - y0 + h), (x - x0):(x - x0 + w)]) # NOTE: the object is within its bbox
+        n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(thresh, 4, cv2.CV_32S)
+        match = np.flatnonzero((stats[:, 0] == 0) & (stats[:, 1] == 0) & (stats[:, 2] == w) 
+                               & (stats[:, 3] == h) & (stats[:, 4] == obj_area))
+        match = match[match > 0]
+        if len(match) == 0: 
+            contours.append(None)
+            continue
+        mask = (labels == match[0]).astype(np.uint8)
+        contours_i, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(int(x), int(y)))
+        contours.append(max(contours_i, key=len).reshape(-1, 2) if len(contours_i) > 0 else None)
+    return contours
@@ -10,7 +10,6 @@ Start with the simple case of matching by size and distance.
 Suitable for processing a recorded video, not a live video feed.
 
 """
-from copy import deepcopy
 #import uuid
 #import json
 #from pathlib import Path
@@ -22,6 +21,9 @@ import numpy as np
 from matplotlib import pyplot as plt
 from rich import progress
 
+from ...objects import ObjectTable
+from ...tracks import TrackStore
+
 PRINT_OBJ_INFO_FLAG = False
 
 params = {
@@ -38,6 +40,10 @@ params = {
         {"name": "area_wt", "title": "Area error weight", "type":  "float", "value": 1, "limits": [0, 100]},
         {"name": "area_square", "title": "Area error square", "type":  "bool", "value": True,},
         {"name": "error_threshold", "title": "Error threshold", "type":  "float", "limits": [1, 1e6], "value": 1e3},
+        {"name": "assignment", "title": "Assignment", "type":  "list", "values": ["greedy", "optimal"], "value": "greedy"},
+        {"name": "motion_predict", "title": "Predict motion", "type":  "bool", "value": False},
+        {"name": "motion_dist_min", "title": "Motion dist min", "type":  "float", "limits": [0, 3000], "value": 10},
+        {"name": "motion_dist_k", "title": "Motion dist k", "type":  "float", "limits": [0, 100], "value": 3},
 
     ]
 }
@@ -55,13 +61,17 @@ class LinkerParams():
     area_wt:float=1
     area_square:bool=True
     error_threshold:float=1e3
+    assignment:str="greedy" # "greedy": tracks in order take their best object, "optimal": lowest total error per frame
+    motion_predict:bool=False # search around the constant-velocity prediction of tracks with 2+ objects
+    motion_dist_min:float=10 # search radius (px) around a prediction ...
+    motion_dist_k:float=3 # ... plus motion_dist_k times the last change of velocity (px/frame), or the last step length
 
 def linker(tracks, objs, frame_idx, n_frames, obj_selection="none", linker_kwargs=None, **kwargs): 
     """ 
     custom linker algorithm.
 
     Parameters: 
-        tracks (dict): tracks in dict with keys (track_idx, frame_idx) 
+        tracks (TrackStore or dict): tracks with keys (track_idx, frame_idx), a dict is converted
         objs (dict): objs in dict with keys frame_idx 
         frame_idx (int): index of image in video 
         n_frames (int): number of frames to track objects through
@@ -74,28 +84,31 @@ def linker(tracks, objs, frame_idx, n_frames, obj_selection="none", linker_kwarg
     else: 
         linker_params = LinkerParams(**linker_kwargs)
 
-    if len(tracks) == 0: 
-        next_track_idx = 1
-    else:     
-        next_track_idx = max(list(set([key[0] for key in list(tracks)]))) + 1
+    if not isinstance(tracks, TrackStore): 
+        tracks = TrackStore(tracks) # NOTE: keeps the tracks in each frame and the track counter between calls
 
     for f_idx in progress.track(range(frame_idx, frame_idx+n_frames), description="[green] Linking objects", total=n_frames): 
  
-        track_idxs = [key[0] for key in tracks if (key[1]==(f_idx-1))]  # tracks existing in prev. frame
+        track_idxs = tracks.in_frame(f_idx-1)  # tracks existing in prev. frame
         if len(objs[f_idx])==0: # not objects in frame
             continue 
 
-        for track_idx in track_idxs: 
-            obj = tracks[(track_idx, f_idx-1)] # get last obj added to the track
-            obj_idx, match_error = _match_obj_in_frame(obj, deepcopy(objs[f_idx]), linker_params=linker_params) # match obj this frame
-            
-            if obj_idx is not None:  
+        if len(track_idxs) > 0: 
+            last_objs = [tracks[(track_idx, f_idx-1)] for track_idx in track_idxs] # last obj added to each track
+            centers, radii = predict_positions(tracks, track_idxs, f_idx, linker_params) if linker_params.motion_predict else (None, None)
+            obj_idxs, t, rows, error = frame_costs(last_objs, objs[f_idx], linker_params, centers=centers, radii=radii) 
+            match_func = match_optimal if linker_params.assignment == "optimal" else match_greedy
+            matches, match_errors = match_func(t, rows, error, len(track_idxs), linker_params.error_threshold)
+
+            for track_idx, row, match_error in zip(track_idxs, matches, match_errors): 
+                if row < 0: # no match, track is terminated
+                    continue 
+                obj_idx = obj_idxs[row].item()
                 obj_n = objs[f_idx][obj_idx]
                 obj_n["track_idx"] = track_idx
                 obj_n["match_error"] = match_error
                 tracks[(track_idx, f_idx)] = obj_n # add matched object to the track
                 objs[f_idx].pop(obj_idx) # remove this obj from objs  
-            # else: no match, track is terminated
             
         # NOTE: integrate new object selection with linker so objects from f_idx may be linked in f_idx + 1
         if obj_selection == "auto": 
@@ -103,9 +116,8 @@ def linker(tracks, objs, frame_idx, n_frames, obj_selection="none", linker_kwarg
             for obj_idx in obj_idxs: 
                 obj_n = objs[f_idx][obj_idx]
                 obj_n["match_error"] = 0
-                tracks[(next_track_idx, f_idx)] = obj_n # add selected object to new track
+                tracks[(tracks.new_track_idx(), f_idx)] = obj_n # add selected object to new track
                 objs[f_idx].pop(obj_idx)
-                next_track_idx += 1
 
     return tracks, objs
 
@@ -114,26 +126,93 @@ def obj_selection_auto(objs):
     # TODO set some critiera for tracking objects. for now, simply re-add all if in auto
     return list(objs)
 
-def _match_obj_in_frame(obj, objs, linker_params): 
-    """ """  
-    if linker_params is None: linker_params = LinkerParams() # apply the defaults
-    
-    if linker_params.dist_max_filt: 
-        dist_max = linker_params.dist_max_filt_m*obj["obj_area"]**linker_params.dist_max_filt_k
-        to_remove = []
-        for obj_idx in objs: 
-            obj_a = obj["obj_centroid"]
-            obj_b = objs[obj_idx]["obj_centroid"]
-            if np.linalg.norm(obj_a-obj_b) > dist_max: 
-                to_remove.append(obj_idx)
-        for obj_idx in to_remove: 
-            objs.pop(obj_idx)
-        if len(objs) == 0: 
-            return None, None
-    
-    dists = np.array([np.linalg.norm(objs[obj_idx]["obj_centroid"] - obj["obj_centroid"]) for obj_idx in objs])
-    areas = np.array([objs[obj_idx]["obj_area"] - obj["obj_area"] for obj_idx in objs])
+def _obj_column(objs, key): 
+    """ key of each object in objs as an array, from the columns of an ObjectTable if possible """
+    if isinstance(objs, ObjectTable): 
+        return objs.column(key)
+    return np.array([objs[obj_idx][key] for obj_idx in objs])
+
+def predict_positions(tracks, track_idxs, f_idx, linker_params): 
+    """ 
+    Constant-velocity prediction of the centroid of each track in f_idx 
+
+    The velocity is the last step of the track. The search radius is 
+        motion_dist_min plus motion_dist_k times the change of velocity over 
+        the step before, so steadily settling flocs get a small window. Tracks 
+        without an object in f_idx-3 have no change of velocity to measure, 
+        the last step length is used instead (an unknown change of up to one 
+        step). 
+
+    Returns: 
+        centers (array): T x 2 predicted centroids, nan if not predicted
+        radii (array): search radius of each track, inf for tracks without 
+            objects in f_idx-1 and f_idx-2 (not predicted)
+    """
+    centers = np.full((len(track_idxs), 2), np.nan)
+    radii = np.full(len(track_idxs), np.inf)
+    for i, track_idx in enumerate(track_idxs): 
+        obj_1, obj_2 = tracks.get((track_idx, f_idx-1)), tracks.get((track_idx, f_idx-2))
+        if (obj_1 is None) or (obj_2 is None): 
+            continue 
+        c1, c2 = np.asarray(obj_1["obj_centroid"], dtype=float), np.asarray(obj_2["obj_centroid"], dtype=float)
+        centers[i] = 2*c1 - c2
+        obj_3 = tracks.get((track_idx, f_idx-3))
+        if obj_3 is None: # NOTE: a single step, the least reliable prediction
+            accel = np.linalg.norm(c1 - c2)
+        else: 
+            accel = np.linalg.norm(c1 - 2*c2 + np.asarray(obj_3["obj_centroid"], dtype=float))
+        radii[i] = linker_params.motion_dist_min + linker_params.motion_dist_k*accel
+    return centers, radii
+
+def frame_costs(last_objs, objs, linker_params, centers=None, radii=None): 
+    """ 
+    Match error between the last object of each track and the objects of a frame 
+
+    The cost matrix is sparse, as (track, object, error) triplets: with 
+        dist_max_filt only the pairs within dist_max are formed (see grid_pairs), 
+        otherwise every pair is. Errors are computed as array operations over 
+        all pairs at once. 
+
+    Parameters: 
+        last_objs (list): last object of each track 
+        objs (dict or ObjectTable): objects of the frame
+        linker_params (LinkerParams): gating and error weights
+        centers, radii (array): predicted centroids and search radii (see 
+            predict_positions), distances are from the prediction where it is set
+
+    Returns: 
+        obj_idxs (array): obj_idx of each row of objs
+        t, rows, error (array): track (position in last_objs), row and error of each pair
+    """
     obj_idxs = np.array(list(objs))
+    centroids = _obj_column(objs, "obj_centroid").reshape(-1, 2)
+    areas = _obj_column(objs, "obj_area")
+    track_centroids = np.array([obj["obj_centroid"] for obj in last_objs]).reshape(-1, 2)
+    track_areas = np.array([obj["obj_area"] for obj in last_objs])
+
+    if linker_params.dist_max_filt: 
+        dist_max = linker_params.dist_max_filt_m*track_areas**linker_params.dist_max_filt_k
+    else: 
+        dist_max = np.full(len(last_objs), np.inf)
+    if centers is not None: 
+        predicted = np.isfinite(radii)
+        track_centroids = np.where(predicted[:, None], centers, track_centroids)
+        dist_max = np.where(predicted, np.minimum(dist_max, radii), dist_max)
+
+    gated = np.isfinite(dist_max).any()
+    if gated: 
+        grid = grid_index(centroids, np.median(dist_max[np.isfinite(dist_max)]))
+        t, rows = grid_pairs(grid, track_centroids, dist_max)
+    else: 
+        t = np.repeat(np.arange(len(last_objs)), len(obj_idxs))
+        rows = np.tile(np.arange(len(obj_idxs)), len(last_objs))
+
+    dists = np.linalg.norm(centroids[rows] - track_centroids[t], axis=1)
+    areas = areas[rows] - track_areas[t]
+
+    if gated: 
+        in_range = dists <= dist_max[t]
+        t, rows, dists, areas = t[in_range], rows[in_range], dists[in_range], areas[in_range]
     
     if PRINT_OBJ_INFO_FLAG: print(f"Dists: {dists}, Areas: {areas}")
     
@@ -147,10 +226,176 @@ def _match_obj_in_frame(obj, objs, linker_params):
     
     if PRINT_OBJ_INFO_FLAG: 
         print(f"Error: {error} (threshold={linker_params.error_threshold})")
-    
-    idx_min = np.argmin(error)
-    
-    if error[idx_min] < linker_params.error_threshold: 
-        return obj_idxs[idx_min], error[idx_min]
-    else: 
-        return None, None
+
+    return obj_idxs, t, rows, error
+
+def match_greedy(t, rows, error, n_tracks, error_threshold): 
+    """ 
+    Match each track, in order, to its lowest error object not taken by an earlier track 
+
+    Ties go to the first object of the frame. 
+
+    Returns: 
+        matches (list): row matched to each track, -1 if none is below error_threshold
+        match_errors (list): error of each match, None if unmatched
+    """
+    below = error < error_threshold
+    t, rows, error = t[below], rows[below], error[below]
+    order = np.lexsort((rows, error, t)) # by track, then error
+    t, rows, error = t[order], rows[order], error[order]
+    bounds = np.searchsorted(t, np.arange(n_tracks + 1))
+
+    matches, match_errors = [-1]*n_tracks, [None]*n_tracks
+    taken = set()
+    rows_l = rows.tolist()
+    for i in range(n_tracks): 
+        for j in range(bounds[i], bounds[i+1]): 
+            if rows_l[j] not in taken: 
+                taken.add(rows_l[j])
+                matches[i], match_errors[i] = rows_l[j], error[j]
+                break
+    return matches, match_errors
+
+def match_optimal(t, rows, error, n_tracks, error_threshold): 
+    """ 
+    Match tracks to objects with the lowest total error over the frame 
+
+    A track left unmatched costs error_threshold, so a track gives up its 
+        object only when that lowers the total. The pairs below error_threshold 
+        form a bipartite graph between tracks and objects; each connected 
+        component is an independent assignment problem, solved with 
+        hungarian(). In dense frames the components stay small. 
+
+    Returns: 
+        matches (list): row matched to each track, -1 if none
+        match_errors (list): error of each match, None if unmatched
+    """
+    below = error < error_threshold
+    t, rows, error = t[below], rows[below], error[below]
+    matches, match_errors = [-1]*n_tracks, [None]*n_tracks
+
+    for comp in _components(t, rows): 
+        t_c, rows_c, error_c = t[comp], rows[comp], error[comp]
+        tracks_c, ti = np.unique(t_c, return_inverse=True)
+        objs_c, oi = np.unique(rows_c, return_inverse=True)
+        n, m = len(tracks_c), len(objs_c)
+        # columns: objects, then one "unmatched" column per track
+        big = (n + 1)*(np.abs(error_c).max() + error_threshold) + 1 # NOTE: larger than any assignment without it
+        costs = np.full((n, m + n), big)
+        costs[ti, oi] = error_c
+        costs[np.arange(n), m + np.arange(n)] = error_threshold
+        assigned = np.argmin(costs, axis=1) if n == 1 else hungarian(costs)
+        for i, j in enumerate(assigned.tolist()): 
+            if j < m: 
+                matches[tracks_c[i]], match_errors[tracks_c[i]] = objs_c[j].item(), costs[i, j]
+    return matches, match_errors
+
+def _components(t, rows): 
+    """ pairs (indices into t, rows) of each connected component of the track-object graph """
+    if len(t) == 0: 
+        return []
+    a, b = t, rows + t.max() + 1 # nodes: tracks, then objects
+    labels = np.arange(b.max() + 1)
+    while True: # NOTE: min-label propagation with pointer jumping, a few passes
+        low = np.minimum(labels[a], labels[b])
+        new = labels.copy()
+        np.minimum.at(new, a, low)
+        np.minimum.at(new, b, low)
+        new = new[new]
+        if np.array_equal(new, labels): 
+            break
+        labels = new
+    roots = labels[a]
+    order = np.argsort(roots, kind="stable")
+    splits = np.flatnonzero(np.diff(roots[order])) + 1
+    return np.split(order, splits)
+
+def hungarian(costs): 
+    """ 
+    Minimum cost assignment of each row of costs to a distinct column (n <= m) 
+
+    Shortest augmenting path form of the Hungarian algorithm, O(n^2 m), with 
+        the scan over columns as array operations. 
+
+    Returns: 
+        assigned (array): column of each row
+    """
+    n, m = costs.shape
+    u, v = np.zeros(n + 1), np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=np.int64) # row (1-based) assigned to each column, column 0 is the root
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1): 
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True: 
+            used[j0] = True
+            i0 = p[j0]
+            cur = costs[i0 - 1] - u[i0] - v[1:]
+            free = ~used[1:]
+            update = free & (cur < minv[1:])
+            minv[1:][update] = cur[update]
+            way[1:][update] = j0
+            j1 = np.argmin(np.where(free, minv[1:], np.inf)) + 1
+            delta = minv[j1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+            j0 = j1
+            if p[j0] == 0: 
+                break
+        while j0 != 0: # augment along the path
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    assigned = np.zeros(n, dtype=np.int64)
+    assigned[p[1:][p[1:] > 0] - 1] = np.flatnonzero(p[1:] > 0)
+    return assigned
+
+def grid_index(centroids, cell): 
+    """ Uniform grid over centroids, to find the centroids near a point
+
+    Centroids are sorted by grid cell (column-major), so the centroids in the cells
+        of one grid column are a contiguous slice found with searchsorted. 
+
+    Parameters: 
+    ----------
+        centroids (array): N x 2 (x, y)
+        cell (float): grid spacing (px), e.g. the typical search radius, inf for one cell
+    Returns: 
+    ----------
+        grid (dict): the index
+    """
+    cell = max(float(cell), 1.0) if not np.isnan(cell) else np.inf
+    origin = centroids.min(axis=0) if len(centroids) > 0 else np.zeros(2)
+    cells = np.floor((centroids - origin)/cell).astype(np.int64)
+    n_cells = cells.max(axis=0) + 1 if len(centroids) > 0 else np.ones(2, dtype=np.int64)
+    keys = cells[:, 0]*n_cells[1] + cells[:, 1]
+    order = np.argsort(keys, kind="stable")
+    return {"cell": cell, "origin": origin, "n_cells": n_cells, "order": order, "keys": keys[order]}
+
+def grid_pairs(grid, points, radii): 
+    """ 
+    (point, row) pairs of the centroids in the grid cells within radius of each point, 
+        a superset of the centroids within radius 
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    if (len(grid["keys"]) == 0) | (len(points) == 0): 
+        return empty, empty
+    radii = np.reshape(radii, (-1, 1))
+    lo = np.maximum(np.floor((points - radii - grid["origin"])/grid["cell"]), 0)
+    hi = np.minimum(np.floor((points + radii - grid["origin"])/grid["cell"]), grid["n_cells"] - 1)
+    lo, hi = np.nan_to_num(lo).astype(np.int64), np.nan_to_num(hi).astype(np.int64)
+    n_cols = np.where((hi >= lo).all(axis=1), hi[:, 0] - lo[:, 0] + 1, 0)
+
+    p = np.repeat(np.arange(len(points)), n_cols) # one entry per (point, grid column)
+    x = lo[p, 0] + _ranges(n_cols)
+    starts = np.searchsorted(grid["keys"], x*grid["n_cells"][1] + lo[p, 1], side="left")
+    lengths = np.searchsorted(grid["keys"], x*grid["n_cells"][1] + hi[p, 1], side="right") - starts
+    return np.repeat(p, lengths), grid["order"][np.repeat(starts, lengths) + _ranges(lengths)]
+
+def _ranges(lengths): 
+    """ concatenated np.arange(n) for each n of lengths """
+    return np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
@@ -0,0 +1,80 @@
+"""
+safas/morphology.py
+
+Shape properties of labeled objects, computed on demand (e.g. for the objects
+    of saved tracks) and kept on the object.
+"""
+import cv2
+import numpy as np
+
+from .objects import ragged_column
+
+MORPHOLOGY_KEYS = ["obj_major_axis", "obj_minor_axis", "obj_equiv_diameter", "obj_perimeter",
+                   "obj_circularity", "obj_aspect_ratio"]
+
+def morphology(objs):
+    """ Shape properties of objs (object dicts), each computed once and kept on the object
+
+    Objects that already hold a property (e.g. axes from a labeler run with
+        cal_axis_length) are not computed again. Perimeters come from one
+        vectorized pass over all contours; the axes are those of cv2.fitEllipse
+        (see fit_axes), the only per-object step.
+
+    Returns:
+    ----------
+        props (dict): key of MORPHOLOGY_KEYS: array with one value per object, in px
+    """
+    todo = [obj for obj in objs if any(obj.get(key) is None for key in MORPHOLOGY_KEYS)]
+    if len(todo) > 0:
+        contours = [obj.get("obj_contour") for obj in todo]
+        area = np.array([obj["obj_area"] for obj in todo], dtype=float)
+        perimeter = contour_perimeters(contours)
+        axes = np.array([(obj["obj_major_axis"], obj["obj_minor_axis"]) if obj.get("obj_major_axis") is not None
+                         else fit_axes(contour, obj["obj_bbox"]) for obj, contour in zip(todo, contours)],
+                        dtype=float).reshape(-1, 2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            props = {
+                "obj_major_axis": axes[:, 0],
+                "obj_minor_axis": axes[:, 1],
+                "obj_equiv_diameter": np.sqrt(4*area/np.pi),
+                "obj_perimeter": perimeter,
+                "obj_circularity": 4*np.pi*area/perimeter**2,
+                "obj_aspect_ratio": axes[:, 1]/axes[:, 0],
+            }
+        for i, obj in enumerate(todo):
+            for key in MORPHOLOGY_KEYS:
+                if obj.get(key) is None: obj[key] = props[key][i].item()
+    return {key: np.array([obj[key] for obj in objs], dtype=float) for key in MORPHOLOGY_KEYS}
+
+def contour_perimeters(contours):
+    """ length of each closed contour (N x 2, or None for nan), as cv2.arcLength, in one pass """
+    _, (values, starts, lengths) = ragged_column(contours)
+    perimeter = np.full(len(contours), np.nan)
+    present = lengths > 0
+    if not present.any():
+        return perimeter
+
+    values = values.reshape(-1, 2).astype(float)
+    nxt = np.arange(1, len(values) + 1) # next point of each point, the first of its contour for the last
+    last = starts[present] + lengths[present] - 1
+    nxt[last] = starts[present]
+    seg = np.hypot(*(values[nxt] - values).T)
+    perimeter[present] = np.add.reduceat(seg, starts[present]) if len(seg) > 0 else 0
+    return perimeter
+
+def fit_axes(contour, bbox):
+    """ (major, minor) axis of the ellipse fit to contour, the bbox sides if the fit fails """
+    x,y,w,h = bbox
+    try:
+        (xm,ym),(ma,mi),angle = cv2.fitEllipse(contour)
+        major_axis = max(ma,mi)
+        minor_axis = min(ma,mi)
+    except:
+        major_axis = max(w,h)
+        minor_axis = min(w,h)
+
+    if not np.isfinite(major_axis):
+        major_axis = max(w,h)
+    if not np.isfinite(minor_axis):
+        minor_axis = min(w,h)
+    return major_axis, minor_axis
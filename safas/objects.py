@@ -0,0 +1,225 @@
+"""
+safas/objects.py
+
+Column store for the objects labeled in one frame.
+"""
+from collections.abc import MutableMapping
+from copy import deepcopy
+
+import numpy as np
+
+OBJ_KEYS = ["obj_idx", "track_idx", "frame_idx", "obj_area", "obj_centroid", "obj_contour", "obj_contour_cv",
+            "obj_bbox", "obj_major_axis", "obj_minor_axis", "obj_img", "obj_img_mask", "image_size"]
+
+class ObjectTable(MutableMapping):
+    """ Objects of one frame stored by column, read and written like a dict of object dicts
+
+    Each object key is one column of kind:
+        "const": one value shared by all objects, e.g. frame_idx
+        "numbers": Python ints or floats, as one array
+        "stack": equal-shape arrays or NumPy scalars, one row per object (area, centroid, bbox)
+        "ragged": arrays of varying length in one buffer (contours), see ragged_column
+        "nested": lists of arrays in one buffer, see nested_column
+        "list": anything else, as is
+    The contour is stored once, obj_contour_cv is built from obj_contour when it
+        is not a column of its own.
+
+    table[key] returns a new object dict: changes to it are kept only when it is
+        assigned back (table[key] = obj). Popped objects leave the columns; assigned
+        objects are kept as dicts next to them. Column arrays are shared between
+        copies and never modified in place.
+
+    Parameters:
+    ----------
+        keys (array): object keys, one per row
+        cols (dict): key: (kind, data)
+        fields (list): object keys in the order of the object dicts, OBJ_KEYS if None
+    """
+    def __init__(self, keys, cols, fields=None):
+        self.obj_keys = np.asarray(keys)
+        self.cols = cols
+        self.fields = list(OBJ_KEYS if fields is None else fields)
+        self._rows = {key: row for row, key in enumerate(self.obj_keys.tolist())} # objects in the columns
+        self._added = dict() # objects assigned as dicts
+
+    @classmethod
+    def from_objects(cls, objs):
+        """ ObjectTable from a dict of object dicts, e.g. from a labeler """
+        if isinstance(objs, ObjectTable):
+            return objs
+        values = list(objs.values())
+        fields = list(values[0].keys()) if len(values) > 0 else list(OBJ_KEYS)
+        cols = {key: _column([obj[key] for obj in values]) for key in fields} if len(values) > 0 else dict()
+        if ("obj_contour_cv" in cols) and _is_derived_cv(values):
+            cols.pop("obj_contour_cv")
+        return cls(list(objs.keys()), cols, fields=fields)
+
+    def __len__(self): return len(self._rows) + len(self._added)
+
+    def __iter__(self):
+        yield from self._rows
+        yield from self._added
+
+    def __contains__(self, key): return (key in self._rows) or (key in self._added)
+
+    def __getitem__(self, key):
+        if key in self._added:
+            return self._added[key]
+        row = self._rows[key]
+        return {field: self._value(field, row) for field in self.fields}
+
+    def __setitem__(self, key, obj):
+        self._rows.pop(key, None)
+        self._added[key] = obj
+
+    def __delitem__(self, key):
+        if key in self._added:
+            del self._added[key]
+        else:
+            del self._rows[key]
+
+    def __repr__(self): return f"ObjectTable({len(self)} objects)"
+
+    def value(self, key, field):
+        """ one value of one object, without building the object dict """
+        if key in self._added:
+            return self._added[key][field]
+        return self._value(field, self._rows[key])
+
+    def column(self, field):
+        """ values of field for all objects, in iteration order, as an array """
+        kind, data = self.cols.get(field, ("const", None))
+        if (len(self._added) == 0) & (kind in ["numbers", "stack"]):
+            return data[np.fromiter(self._rows.values(), dtype=int, count=len(self._rows))]
+        return np.asarray([self.value(key, field) for key in self])
+
+    @property
+    def nbytes(self):
+        """ bytes held by the column arrays """
+        nbytes = 0
+        for kind, data in self.cols.values():
+            for item in (data if isinstance(data, tuple) else (data,)):
+                if isinstance(item, np.ndarray): nbytes += item.nbytes
+        return nbytes
+
+    def offset(self, dx, dy):
+        """ shift centroids, bboxes and contours by (dx, dy), e.g. from roi to full-frame coordinates """
+        shift = np.array([dx, dy])
+        for field, d in [("obj_centroid", shift), ("obj_bbox", np.array([dx, dy, 0, 0])), ("obj_contour", shift)]:
+            kind, data = self.cols.get(field, ("const", None))
+            if kind in ["numbers", "stack"]:
+                self.cols[field] = (kind, data + d.astype(data.dtype))
+            elif kind == "ragged":
+                values, starts, lengths = data
+                self.cols[field] = (kind, (values + d.astype(values.dtype), starts, lengths))
+            elif kind == "list":
+                self.cols[field] = (kind, [None if v is None else v + d for v in data])
+        kind, data = self.cols.get("obj_contour_cv", ("const", None))
+        if kind == "nested":
+            values, starts, lengths, firsts, counts = data
+            self.cols["obj_contour_cv"] = (kind, (values + shift.reshape(1, 1, 2).astype(values.dtype), starts, lengths, firsts, counts))
+        for obj in self._added.values():
+            obj["obj_centroid"] = obj["obj_centroid"] + shift
+            obj["obj_bbox"] = obj["obj_bbox"] + np.array([dx, dy, 0, 0])
+            if obj.get("obj_contour") is not None:
+                obj["obj_contour"] = obj["obj_contour"] + shift
+            if obj.get("obj_contour_cv") is not None:
+                obj["obj_contour_cv"] = [c + shift.reshape(1, 1, 2) for c in obj["obj_contour_cv"]]
+        return self
+
+    def copy(self):
+        """ new table on the same columns, objects can be popped or assigned independently """
+        table = ObjectTable.__new__(ObjectTable)
+        table.obj_keys, table.cols, table.fields = self.obj_keys, dict(self.cols), self.fields
+        table._rows = dict(self._rows)
+        table._added = dict(self._added)
+        return table
+
+    def __copy__(self): return self.copy()
+
+    def __deepcopy__(self, memo): # NOTE: columns are shared, they are never modified in place
+        table = self.copy()
+        table._added = deepcopy(self._added, memo)
+        return table
+
+    def __getstate__(self):
+        rows = np.fromiter(self._rows.values(), dtype=int, count=len(self._rows))
+        return {"obj_keys": self.obj_keys, "cols": self.cols, "fields": self.fields, "rows": rows, "added": self._added}
+
+    def __setstate__(self, state):
+        self.obj_keys, self.cols, self.fields = state["obj_keys"], state["cols"], state["fields"]
+        self._rows = {self.obj_keys[row].item(): row for row in state["rows"].tolist()}
+        self._added = state["added"]
+
+    def _value(self, field, row):
+        kind, data = self.cols.get(field, ("const", None))
+        if kind == "const":
+            if (field == "obj_contour_cv") & (field not in self.cols):
+                contour = self._value("obj_contour", row)
+                return None if contour is None else [contour.reshape(-1, 1, 2)]
+            return data
+        if kind == "numbers":
+            return data[row].item()
+        if kind == "stack":
+            return data[row]
+        if kind == "ragged":
+            values, starts, lengths = data
+            return None if lengths[row] < 0 else values[starts[row]:(starts[row] + lengths[row])]
+        if kind == "nested":
+            values, starts, lengths, firsts, counts = data
+            pieces = range(firsts[row], firsts[row] + counts[row])
+            return [values[starts[i]:(starts[i] + lengths[i])] for i in pieces]
+        return data[row]
+
+def ragged_column(arrays):
+    """ ("ragged", (values, starts, lengths)) column from arrays (or None) with the same trailing shape """
+    lengths = np.array([-1 if a is None else len(a) for a in arrays], dtype=np.int64)
+    starts = np.cumsum(np.maximum(lengths, 0)) - np.maximum(lengths, 0)
+    present = [a for a in arrays if a is not None]
+    values = np.concatenate(present) if len(present) > 0 else np.zeros((0, 2), dtype=np.int32)
+    return ("ragged", (values, starts, lengths))
+
+def nested_column(lists):
+    """ ("nested", (values, starts, lengths, firsts, counts)) column from lists of arrays, e.g. cv2 contours """
+    counts = np.array([len(v) for v in lists], dtype=np.int64)
+    firsts = np.cumsum(counts) - counts
+    _, (values, starts, lengths) = ragged_column([a for v in lists for a in v])
+    return ("nested", (values, starts, lengths, firsts, counts))
+
+def _column(col):
+    """ smallest column kind that holds col exactly """
+    first = col[0]
+    if all(((v is None) | np.isscalar(v)) for v in col) and all((v is first) or (v == first) for v in col):
+        return ("const", first)
+    if isinstance(first, tuple) and all(np.isscalar(x) for x in first) and all(v == first for v in col):
+        return ("const", first)
+    types = {type(v) for v in col}
+    if (types == {int}) | (types == {float}):
+        return ("numbers", np.asarray(col))
+    if (len(types) == 1) and all(isinstance(v, np.ndarray) | isinstance(v, np.generic) for v in col) \
+        and (len({(np.shape(v), v.dtype) for v in col}) == 1):
+        return ("stack", np.asarray(col))
+    if all(isinstance(v, np.ndarray) | (v is None) for v in col):
+        if len({(v.shape[1:], v.dtype) for v in col if v is not None}) == 1:
+            return ragged_column(col)
+    if all(isinstance(v, list) and all(isinstance(a, np.ndarray) for a in v) for v in col):
+        arrays = [a for v in col for a in v]
+        if (len(arrays) > 0) and (len({(a.shape[1:], a.dtype) for a in arrays}) == 1):
+            return nested_column(col)
+    return ("list", col)
+
+def _is_derived_cv(objs):
+    """ True if each obj_contour_cv is [obj_contour] in cv2 format """
+    for obj in objs:
+        contour, contour_cv = obj.get("obj_contour"), obj["obj_contour_cv"]
+        if (contour is None) & (contour_cv is None):
+            continue
+        if (contour is None) or (contour_cv is None) or (not isinstance(contour_cv, list)) or (len(contour_cv) != 1):
+            return False
+        if (contour_cv[0].dtype != contour.dtype) or (not np.array_equal(contour_cv[0].reshape(-1, 2), contour)):
+            return False
+    return True
+
+def as_tables(objs):
+    """ ObjectTable for each frame of objs (frame_idx: objects) """
+    return {frame_idx: ObjectTable.from_objects(objs_f) for frame_idx, objs_f in objs.items()}
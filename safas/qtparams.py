@@ -33,7 +33,29 @@ PARAMS = [
     {"name": "process_on_new_frame", "type": "bool", "value": True},
     {"name": "process_n_frames", "type": "bool", "value": False},
     {"name": "n_frames", "type": "int", "value": 50},
+    {"name": "fps", "title": "Frame rate (image sources)", "type": "float", "value": 30.0, "limits": [0.001, 1e6]},
+    {"name": "ingest", "title": "Ingest video (raw store)", "type": "bool", "value": False},
+    {"name": "result_cache", "title": "Keep labels on disk", "type": "bool", "value": False},
+    {"name": "grayscale", "title": "Grayscale frames", "type": "bool", "value": False},
+    {"name": "roi", "title": "Region of interest", "type": "group", "expanded": False, "children": [
+        {"name": "x", "type": "int", "value": 0, "limits": [0, 1e5]},
+        {"name": "y", "type": "int", "value": 0, "limits": [0, 1e5]},
+        {"name": "w", "title": "w (0: full frame)", "type": "int", "value": 0, "limits": [0, 1e5]},
+        {"name": "h", "title": "h (0: full frame)", "type": "int", "value": 0, "limits": [0, 1e5]},
+    ]},
+    {"name": "background", "title": "Background model", "type": "group", "expanded": False, "children": [
+        {"name": "apply", "title": "Label foreground only", "type": "bool", "value": False},
+        {"name": "method", "type": "list", "value": "median", "values": ["median", "mean"]},
+        {"name": "history", "title": "History (frames)", "type": "int", "value": 50, "limits": [1, 10000]},
+        {"name": "fg_thresh", "title": "Foreground threshold", "type": "int", "value": 15, "limits": [0, 255]},
+        {"name": "dilate_px", "title": "Foreground margin (px)", "type": "int", "value": 3, "limits": [0, 100]},
+    ]},
     {"name": "n_threads", "type": "int", "value": 6, "visible": False},
+    {"name": "backend", "title": "Labeler backend", "type": "list", "value": "thread", "values": ["thread", "process"]},
+    {"name": "n_decoders", "type": "int", "value": 1, "limits": [1, 64], "visible": False},
+    {"name": "frame_cache_mb", "type": "int", "value": 1024, "visible": False},
+    {"name": "prefetch_depth", "type": "int", "value": 16, "limits": [0, 1000], "visible": False},
+    {"name": "prefetch_mb", "type": "int", "value": 256, "visible": False},
 ]
 },
 {"name": "labeler", "title": "Labeler", "type": "group",
@@ -0,0 +1,227 @@
+"""
+safas/results.py
+
+Labeler results kept on disk next to the source, so frames labeled once with
+    the same settings are read back instead of labeled again.
+"""
+from pathlib import Path
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from .prints import print_handler as print
+from .objects import ObjectTable
+
+STORE_SUFFIX = ".safas-labels" # results of <source> are in <source>.safas-labels/<settings digest>/
+
+def settings_digest(settings):
+    """ digest of the labeler settings (dict of JSON-like values), the key of a result store """
+    text = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=12).hexdigest()
+
+def source_stat(data_file):
+    st = os.stat(data_file)
+    return {"path": str(Path(data_file).resolve()), "mtime": st.st_mtime, "size": st.st_size}
+
+class ResultStore():
+    """ Objects labeled in each frame of a source with one set of labeler settings
+
+    Results are written in chunks, one per labeler run. A chunk stores each
+        column of the ObjectTables (see safas.objects) concatenated over its
+        frames as a .npy file, and constant columns and the rows of each frame
+        in meta.json. Chunks are memory-mapped when read, so loading the objects
+        of many frames builds tables over views rather than decoding files.
+
+    The store is cleared when the mtime or size of the source changes. Frames
+        labeled again are read from the latest chunk.
+
+    Parameters:
+    ----------
+        data_file (str): source the frames were read from
+        settings (dict): everything the objects depend on, e.g. labeler name and
+            kwargs, roi, background model
+    """
+    def __init__(self, data_file, settings):
+        self.data_file = str(data_file)
+        self.settings = settings
+        self.path = Path(f"{data_file}{STORE_SUFFIX}").joinpath(settings_digest(settings))
+        self._frames = None # frame_idx: (chunk, i), read on first use
+
+    def __contains__(self, frame_idx): return frame_idx in self.frames
+
+    def __len__(self): return len(self.frames)
+
+    @property
+    def frames(self):
+        if self._frames is None:
+            self._frames = self._index()
+        return self._frames
+
+    def read(self, frame_idxs):
+        """ dict of frame_idx: ObjectTable for the frames of frame_idxs in the store """
+        return {frame_idx: read_table(*self.frames[frame_idx]) for frame_idx in frame_idxs if frame_idx in self.frames}
+
+    def write(self, objs):
+        """ add a chunk with objs (frame_idx: ObjectTable), False if the tables cannot be stored """
+        if len(objs) == 0:
+            return False
+        try:
+            chunk_path = self._write(objs)
+        except (ValueError, TypeError, OSError) as e:
+            print(f"[cyan]Results[/cyan] objects not stored: {e}", warning=True)
+            return False
+
+        chunk = load_chunk(chunk_path)
+        for i, frame_idx in enumerate(chunk["meta"]["frame_idxs"]):
+            self.frames[frame_idx] = (chunk, i)
+        return True
+
+    def _write(self, objs):
+        stat = source_stat(self.data_file)
+        if (not self.path.exists()) or (self._stat() != stat):
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+            with open(self.path.joinpath("settings.json"), "w") as f:
+                json.dump({"source": stat, "settings": self.settings}, f, default=str)
+            self._frames = dict()
+
+        n = len([p for p in self.path.iterdir() if p.name.startswith("chunk_")])
+        chunk_path = self.path.joinpath(f"chunk_{n:05d}")
+        tmp_path = self.path.joinpath(f"tmp_{n:05d}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        try:
+            write_chunk(tmp_path, objs)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        os.replace(tmp_path, chunk_path) # NOTE: a chunk is complete once renamed
+        return chunk_path
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self._frames = dict()
+
+    def _stat(self):
+        try:
+            with open(self.path.joinpath("settings.json"), "r") as f:
+                return json.load(f)["source"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+    def _index(self):
+        frames = dict()
+        if not self.path.exists():
+            return frames
+        if self._stat() != source_stat(self.data_file):
+            print(f"[cyan]Results[/cyan] stored objects are out of date: {self.path}")
+            return frames
+        for chunk_path in sorted(p for p in self.path.iterdir() if p.name.startswith("chunk_")):
+            try:
+                chunk = load_chunk(chunk_path)
+            except (FileNotFoundError, ValueError, json.JSONDecodeError) as e:
+                print(f"[cyan]Results[/cyan] chunk not read: {e}", warning=True)
+                continue
+            for i, frame_idx in enumerate(chunk["meta"]["frame_idxs"]):
+                frames[frame_idx] = (chunk, i) # NOTE: later chunks replace earlier results
+        return frames
+
+def write_chunk(path, objs):
+    """ Write objs (frame_idx: ObjectTable) as one .npy per column array and meta.json
+
+    Raises:
+    ----------
+        ValueError: if a table has objects outside its columns ("list" columns,
+            objects assigned as dicts) or the columns differ between frames
+    """
+    frame_idxs = sorted(objs)
+    tables = [ObjectTable.from_objects(objs[frame_idx]) for frame_idx in frame_idxs]
+    fields, kinds = None, dict()
+    for table in tables:
+        if (len(table._added) > 0) | (len(table._rows) != len(table.obj_keys)):
+            raise ValueError("tables with assigned or removed objects are not stored")
+        if len(table.obj_keys) == 0: # NOTE: columns of empty tables may be of any kind
+            continue
+        if fields is None:
+            fields = table.fields
+            kinds = {field: kind for field, (kind, data) in table.cols.items()}
+        if (table.fields != fields) | ({field: kind for field, (kind, data) in table.cols.items()} != kinds):
+            raise ValueError("columns differ between frames")
+    if "list" in kinds.values():
+        raise ValueError("list columns (e.g. object images) are not stored")
+
+    counts = np.array([len(table.obj_keys) for table in tables], dtype=np.int64)
+    arrays = {"keys": np.concatenate([table.obj_keys for table in tables]) if len(tables) > 0 else np.zeros(0, dtype=int)}
+    consts, tuples = dict(), []
+    for field, kind in kinds.items():
+        cols = [table.cols[field][1] for table in tables if len(table.obj_keys) > 0]
+        if kind == "const":
+            values = [_const(table, field) for table in tables]
+            if any(isinstance(v, tuple) for v in values): tuples.append(field)
+            consts[field] = [v.item() if isinstance(v, np.generic) else v for v in values]
+        elif kind in ["numbers", "stack"]:
+            arrays[field] = np.concatenate(cols)
+        elif kind == "ragged":
+            arrays.update(_concat_ragged(field, cols))
+        elif kind == "nested":
+            firsts, shift = [], 0
+            for values, starts, lengths, firsts_i, counts_i in cols:
+                firsts.append(firsts_i + shift)
+                shift += len(starts)
+            arrays.update(_concat_ragged(field, [c[:3] for c in cols]))
+            arrays[f"{field}.firsts"] = np.concatenate(firsts)
+            arrays[f"{field}.counts"] = np.concatenate([c[4] for c in cols])
+
+    for name, array in arrays.items():
+        np.save(path.joinpath(f"{name}.npy"), np.ascontiguousarray(array))
+    meta = {"frame_idxs": [int(frame_idx) for frame_idx in frame_idxs], "counts": counts.tolist(),
+            "fields": fields, "kinds": kinds, "consts": consts, "tuples": tuples}
+    with open(path.joinpath("meta.json"), "w") as f:
+        json.dump(meta, f)
+
+def _const(table, field):
+    """ value of a const column, None if the column of this table is of another kind """
+    kind, value = table.cols.get(field, ("const", None))
+    return value if kind == "const" else None
+
+def _concat_ragged(field, cols):
+    """ values, starts and lengths of ragged columns as one column """
+    starts, shift = [], 0
+    for values, starts_i, lengths in cols:
+        starts.append(starts_i + shift)
+        shift += len(values)
+    return {f"{field}.values": np.concatenate([c[0] for c in cols]),
+            f"{field}.starts": np.concatenate(starts),
+            f"{field}.lengths": np.concatenate([c[2] for c in cols])}
+
+def load_chunk(path):
+    """ meta and memory-mapped arrays of a chunk written by write_chunk """
+    with open(path.joinpath("meta.json"), "r") as f:
+        meta = json.load(f)
+    arrays = {p.name[:-len(".npy")]: np.load(p, mmap_mode="r").view(np.ndarray) for p in path.glob("*.npy")}
+    meta["rows"] = np.concatenate([[0], np.cumsum(meta["counts"])]).astype(np.int64)
+    return {"meta": meta, "arrays": arrays}
+
+def read_table(chunk, i):
+    """ ObjectTable of frame i of a chunk, its columns are views of the chunk arrays """
+    meta, arrays = chunk["meta"], chunk["arrays"]
+    r0, r1 = meta["rows"][i], meta["rows"][i + 1]
+    if meta["fields"] is None: # no frame of the chunk had objects
+        return ObjectTable(arrays["keys"][r0:r1], dict())
+
+    cols = dict()
+    for field, kind in meta["kinds"].items():
+        if kind == "const":
+            value = meta["consts"][field][i]
+            cols[field] = (kind, tuple(value) if (field in meta["tuples"]) and (value is not None) else value)
+        elif kind in ["numbers", "stack"]:
+            cols[field] = (kind, arrays[field][r0:r1])
+        elif kind == "ragged":
+            cols[field] = (kind, (arrays[f"{field}.values"], arrays[f"{field}.starts"][r0:r1], arrays[f"{field}.lengths"][r0:r1]))
+        elif kind == "nested":
+            cols[field] = (kind, (arrays[f"{field}.values"], arrays[f"{field}.starts"], arrays[f"{field}.lengths"],
+                                  arrays[f"{field}.firsts"][r0:r1], arrays[f"{field}.counts"][r0:r1]))
+    return ObjectTable(arrays["keys"][r0:r1], cols, fields=meta["fields"])
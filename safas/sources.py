@@ -0,0 +1,275 @@
+"""
+safas/sources.py
+
+Frame sources other than video files. Each source implements the subset of the
+    cv2.VideoCapture interface used by safas (get, set, read, grab, retrieve,
+    isOpened, release) plus read_frame(frame_idx) for random access.
+"""
+from abc import ABC, abstractmethod
+from pathlib import Path
+import json
+import os
+import struct
+
+import cv2
+import numpy as np
+from rich import progress
+
+from .prints import print_handler as print
+
+DEFAULT_FPS = 30.0
+STORE_SUFFIX = ".safas" # raw store is <source>.safas.npy, metadata in <source>.safas.json
+IMAGE_EXTENSIONS = [".tif", ".tiff", ".png", ".bmp", ".jpg", ".jpeg"]
+TIFF_EXTENSIONS = [".tif", ".tiff"]
+
+class IndexedCapture(ABC):
+    """ cv2.VideoCapture interface over a source that reads frames by index, subclasses implement __len__ and read_frame """
+    zero_copy = False # read_frame returns a view, no decode
+
+    def __init__(self, source, fps=DEFAULT_FPS):
+        self.source = source
+        self.fps = float(fps)
+        self.pos = 0
+        self.frame_shape = None
+
+    @abstractmethod
+    def __len__(self): pass
+
+    @abstractmethod
+    def read_frame(self, frame_idx):
+        """ return (ret, image) at frame_idx """
+
+    def isOpened(self): return len(self) > 0
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_COUNT: return float(len(self))
+        if prop == cv2.CAP_PROP_FPS: return self.fps
+        if prop == cv2.CAP_PROP_POS_FRAMES: return float(self.pos)
+        if self.frame_shape is None: return 0.0
+        if prop == cv2.CAP_PROP_FRAME_WIDTH: return float(self.frame_shape[1])
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT: return float(self.frame_shape[0])
+        return 0.0 # NOTE: cv2.VideoCapture also returns 0 for unsupported properties
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.pos = int(value)
+            return True
+        return False
+
+    def grab(self):
+        if self.pos >= len(self): return False
+        self.pos += 1
+        return True
+
+    def retrieve(self): return self.read_frame(self.pos - 1)
+
+    def read(self):
+        if not self.grab(): return False, None
+        return self.retrieve()
+
+    def release(self): pass
+
+class ArrayCapture(IndexedCapture):
+    """ Frames from an array-like (N x H x W [x C]), e.g. a np.memmap """
+    zero_copy = True
+
+    def __init__(self, frames, source=None, fps=DEFAULT_FPS):
+        super(ArrayCapture, self).__init__(source, fps=fps)
+        self.frames = frames
+        if len(frames) > 0: self.frame_shape = frames[0].shape
+
+    def __len__(self): return len(self.frames)
+
+    def read_frame(self, frame_idx):
+        if (frame_idx < 0) | (frame_idx >= len(self.frames)):
+            return False, None
+        return True, self.frames[frame_idx]
+
+class ImageSequenceCapture(IndexedCapture):
+    """ Directory of image files, one frame per file, ordered by file name """
+    def __init__(self, path, fps=DEFAULT_FPS):
+        super(ImageSequenceCapture, self).__init__(str(path), fps=fps)
+        self.files = sorted(str(f) for f in Path(path).iterdir() if f.suffix.lower() in IMAGE_EXTENSIONS)
+        if len(self.files) > 0:
+            ret, image = self.read_frame(0)
+            if ret: self.frame_shape = image.shape
+
+    def __len__(self): return len(self.files)
+
+    def read_frame(self, frame_idx):
+        if (frame_idx < 0) | (frame_idx >= len(self.files)):
+            return False, None
+        image = cv2.imread(self.files[frame_idx])
+        return (image is not None), image
+
+class TiffStackCapture(ArrayCapture):
+    """ Uncompressed (multipage) TIFF, each page a zero-copy view of a np.memmap """
+    def __init__(self, filename, fps=DEFAULT_FPS):
+        pages = tiff_pages(filename)
+        self.mm = np.memmap(filename, dtype=np.uint8, mode="r")
+        frames = []
+        for offset, shape, rgb in pages:
+            frame = self.mm[offset:offset + int(np.prod(shape))].reshape(shape)
+            frames.append(frame[..., ::-1] if rgb else frame) # cv2 channel order is BGR
+        super(TiffStackCapture, self).__init__(frames, source=str(filename), fps=fps)
+
+    def release(self):
+        self.frames = []
+        self.mm = None
+
+# TIFF field types: BYTE, ASCII, SHORT, LONG, LONG8 (BigTIFF)
+TIFF_TYPES = {1: "B", 2: "B", 3: "H", 4: "I", 16: "Q"}
+
+def tiff_pages(filename):
+    """ Locate the pixel data of each page in an uncompressed 8-bit TIFF
+
+    Returns:
+    ----------
+        pages (list): (offset, shape, rgb) of each page
+    Raises:
+    ----------
+        ValueError: if the file is not a TIFF or a page cannot be memory-mapped
+    """
+    pages = []
+    with open(filename, "rb") as f:
+        header = f.read(16)
+        order = {b"II": "<", b"MM": ">"}.get(header[:2])
+        if order is None:
+            raise ValueError(f"{filename} is not a TIFF file")
+        magic = struct.unpack(order + "H", header[2:4])[0]
+        if magic == 42:
+            big, ifd = False, struct.unpack(order + "I", header[4:8])[0]
+        elif magic == 43:
+            big, ifd = True, struct.unpack(order + "Q", header[8:16])[0]
+        else:
+            raise ValueError(f"{filename} is not a TIFF file")
+
+        off_fmt, n_fmt, entry_size = ("Q", "Q", 20) if big else ("I", "H", 12)
+        while ifd != 0:
+            f.seek(ifd)
+            n = struct.unpack(order + n_fmt, f.read(struct.calcsize(n_fmt)))[0]
+            entries = f.read(n*entry_size)
+            ifd = struct.unpack(order + off_fmt, f.read(struct.calcsize(off_fmt)))[0]
+
+            tags = dict()
+            for i in range(n):
+                entry = entries[i*entry_size:(i+1)*entry_size]
+                tag, typ = struct.unpack(order + "HH", entry[:4])
+                if typ not in TIFF_TYPES: continue
+                count = struct.unpack(order + off_fmt, entry[4:4 + struct.calcsize(off_fmt)])[0]
+                value = entry[4 + struct.calcsize(off_fmt):]
+                size = count*struct.calcsize(TIFF_TYPES[typ])
+                if size > len(value): # value stored elsewhere in the file
+                    f.seek(struct.unpack(order + off_fmt, value)[0])
+                    value = f.read(size)
+                tags[tag] = struct.unpack(order + TIFF_TYPES[typ]*count, value[:size])
+            pages.append(_tiff_page(filename, tags))
+    return pages
+
+def _tiff_page(filename, tags):
+    """ (offset, shape, rgb) from the tags of one TIFF page """
+    width, height = tags[256][0], tags[257][0]
+    spp = tags.get(277, (1,))[0]
+    if tags.get(259, (1,))[0] != 1:
+        raise ValueError(f"{filename}: compressed TIFF pages cannot be memory-mapped")
+    if any(bits != 8 for bits in tags.get(258, (1,))):
+        raise ValueError(f"{filename}: only 8-bit TIFF pages are supported")
+    if (spp not in [1, 3]) | ((spp > 1) & (tags.get(284, (1,))[0] != 1)):
+        raise ValueError(f"{filename}: only grayscale or interleaved RGB TIFF pages are supported")
+    if 273 not in tags:
+        raise ValueError(f"{filename}: tiled TIFF pages are not supported")
+
+    offsets, counts = tags[273], tags[279]
+    contiguous = all(offsets[i] + counts[i] == offsets[i+1] for i in range(len(offsets)-1))
+    if (not contiguous) | (sum(counts) < width*height*spp):
+        raise ValueError(f"{filename}: TIFF strips are not contiguous")
+
+    shape = (height, width) if spp == 1 else (height, width, spp)
+    return (offsets[0], shape, spp == 3)
+
+def store_paths(data_file):
+    """ (array, metadata) paths of the raw frame store kept next to data_file """
+    return (f"{data_file}{STORE_SUFFIX}.npy", f"{data_file}{STORE_SUFFIX}.json")
+
+def _source_stat(data_file):
+    st = os.stat(data_file)
+    return {"mtime": st.st_mtime, "size": st.st_size}
+
+def load_raw_store(data_file):
+    """ ArrayCapture on the raw store of data_file, None if missing or stale """
+    array_file, meta_file = store_paths(data_file)
+    try:
+        with open(meta_file, "r") as f: meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    stat = _source_stat(data_file)
+    if (meta.get("mtime") != stat["mtime"]) | (meta.get("size") != stat["size"]):
+        print(f"[cyan]Source[/cyan] raw store is out of date: {array_file}")
+        return None
+    try:
+        frames = np.load(array_file, mmap_mode="r")[:meta["frame_count"]]
+    except (FileNotFoundError, ValueError) as e:
+        print(f"[cyan]Source[/cyan] raw store not loaded: {e}", warning=True)
+        return None
+    return ArrayCapture(frames, source=str(data_file), fps=meta["fps"])
+
+def ingest(data_file):
+    """ Decode a video once to a grayscale, memory-mapped .npy next to it
+
+    Later loads reuse the store while the mtime and size of data_file match
+        (see load_raw_store).
+
+    Returns:
+    ----------
+        ArrayCapture over the store
+    """
+    array_file, meta_file = store_paths(data_file)
+    stat = _source_stat(data_file)
+    cap = cv2.VideoCapture(str(data_file))
+    width, height = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = float(cap.get(cv2.CAP_PROP_FPS))
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) # NOTE: an estimate for some codecs
+
+    tmp_file = f"{array_file}.tmp"
+    frames = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.uint8, shape=(frame_count, height, width))
+    n = 0
+    for frame_idx in progress.track(range(frame_count), description="[green] Ingesting frames", total=frame_count):
+        ret, image = cap.read()
+        if not ret: break
+        if image.ndim == 3: image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        frames[frame_idx] = image
+        n += 1
+    cap.release()
+    frames.flush()
+    del frames
+    os.replace(tmp_file, array_file)
+
+    meta = dict(stat, fps=fps, frame_count=n, shape=[height, width])
+    with open(meta_file, "w") as f: json.dump(meta, f) # NOTE: written last, marks the store complete
+    print(f"[cyan]Source[/cyan] {n} frames ingested to {array_file}")
+    return load_raw_store(data_file)
+
+def open_capture(data_file, fps=DEFAULT_FPS, ingest_video=False):
+    """ Capture for a video file, an image directory or an uncompressed TIFF stack
+
+    Parameters:
+    ----------
+        data_file (str): path to the source
+        fps (float): frame rate of image directories and TIFF stacks, which
+            do not store one
+        ingest_video (bool): read videos from a raw frame store, decoding
+            the video once to create it if needed
+    """
+    path = Path(data_file)
+    if path.is_dir():
+        return ImageSequenceCapture(path, fps=fps)
+    if path.suffix.lower() in TIFF_EXTENSIONS:
+        return TiffStackCapture(str(path), fps=fps)
+    if ingest_video:
+        try:
+            cap = load_raw_store(data_file)
+            return cap if cap is not None else ingest(data_file)
+        except OSError as e:
+            print(f"[cyan]Source[/cyan] raw store not written, decoding video instead: {e}", warning=True)
+    return cv2.VideoCapture(str(data_file))
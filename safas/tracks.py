@@ -0,0 +1,93 @@
+"""
+safas/tracks.py
+
+Store for the objects of tracks, shared by the handler, linker and writer.
+"""
+from collections.abc import MutableMapping
+
+import numpy as np
+
+class TrackStore(MutableMapping):
+    """ Objects of tracks, read and written like a dict keyed by (track_idx, frame_idx)
+
+    The store indexes objects by track and by frame as they are added and
+        removed, so linking a frame only looks at the tracks in the previous
+        frame and a track is read or removed without scanning all keys. Track
+        indexes are not reused once the tracks are removed.
+
+    Parameters:
+    ----------
+        entries (dict): (track_idx, frame_idx): obj, e.g. tracks saved as a dict
+    """
+    def __init__(self, entries=None):
+        self._entries = dict()
+        self._tracks = dict() # track_idx: {frame_idx: None}, in the order added
+        self._frames = dict() # frame_idx: {track_idx: None}, in the order added
+        self.next_track_idx = 1
+        if entries is not None:
+            self.update(entries)
+
+    def __len__(self): return len(self._entries)
+
+    def __iter__(self): return iter(self._entries)
+
+    def __contains__(self, key): return key in self._entries
+
+    def __getitem__(self, key): return self._entries[key]
+
+    def __setitem__(self, key, obj):
+        track_idx, frame_idx = key
+        self._entries[key] = obj
+        self._tracks.setdefault(track_idx, dict())[frame_idx] = None
+        self._frames.setdefault(frame_idx, dict())[track_idx] = None
+        self.next_track_idx = max(self.next_track_idx, track_idx + 1)
+
+    def __delitem__(self, key):
+        del self._entries[key]
+        track_idx, frame_idx = key
+        for index, idx, sub_idx in [(self._tracks, track_idx, frame_idx), (self._frames, frame_idx, track_idx)]:
+            del index[idx][sub_idx]
+            if len(index[idx]) == 0:
+                del index[idx]
+
+    def __repr__(self): return f"TrackStore({len(self)} objects)"
+
+    def track_idxs(self, frame_max=None):
+        """ track_idxs in the order added, only the tracks with an object in a frame <= frame_max if set """
+        if frame_max is None:
+            return list(self._tracks)
+        return [track_idx for track_idx, frames in self._tracks.items() if min(frames) <= frame_max]
+
+    def frame_idxs(self):
+        """ frame_idxs with an object of any track """
+        return list(self._frames)
+
+    def track(self, track_idx, frame_max=None):
+        """ frame_idx: obj of track_idx, in the order added, up to frame_max if set """
+        return {frame_idx: self._entries[(track_idx, frame_idx)] for frame_idx in self._tracks.get(track_idx, ())
+                if (frame_max is None) or (frame_idx <= frame_max)}
+
+    def track_arrays(self, track_idx, fields, frame_max=None):
+        """ frame_idx and each field of the objects of track_idx as arrays, in the order added (see track) """
+        track = self.track(track_idx, frame_max=frame_max)
+        arrays = {"frame_idx": np.array(list(track), dtype=np.int64)}
+        for field in fields:
+            arrays[field] = np.array([obj[field] for obj in track.values()])
+        return arrays
+
+    def remove_track(self, track_idx):
+        """ remove the objects of track_idx, returned as frame_idx: obj """
+        track = self.track(track_idx)
+        for frame_idx in track:
+            del self[(track_idx, frame_idx)]
+        return track
+
+    def in_frame(self, frame_idx):
+        """ track_idxs with an object in frame_idx, in the order added """
+        return list(self._frames.get(frame_idx, ()))
+
+    def new_track_idx(self):
+        """ next free track index, reserved for a new track """
+        track_idx = self.next_track_idx
+        self.next_track_idx += 1
+        return track_idx
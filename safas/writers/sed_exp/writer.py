@@ -19,6 +19,9 @@ import cv2
 import numpy as np
 import pandas as pd
 
+from ...morphology import morphology
+from ...tracks import TrackStore
+
 params = {
     "name": "kwargs", 
     "title": "Parameters",
@@ -88,63 +91,37 @@ def writer(output_path, tracks, objs, cap,
         print(f"Saving output to: {output_path}")
     print(f"Object properties caculated using {fps:0.2f} fps and metric pixel conversion of {px_um_cal:0.1f} um/px")
     
-    track_idxs = list(set([key[0] for key in tracks])) # all tracks available
+    if not isinstance(tracks, TrackStore): 
+        tracks = TrackStore(tracks)
+    track_idxs = tracks.track_idxs() # all tracks available
     dfx = [] 
     frame_items = dict()
     print(f"Analyzing {len(track_idxs)} tracks")
     
     for track_idx in track_idxs: 
-        keys = [key for key in tracks if key[0]==track_idx]
-        items = []
+        track = tracks.track_arrays(track_idx, ["obj_idx", "obj_centroid", "obj_area", "match_error"])
         track_uuid = str(uuid.uuid4())
-  
-        for key in keys: 
-            track_idx = key[0]
-            frame_idx = key[1]
-            obj_idx = tracks[key]["obj_idx"]  
-            cent = tracks[key]["obj_centroid"]
-            area = tracks[key]["obj_area"]  
-            contour = tracks[key]["obj_contour"]
-            bbox = tracks[key]["obj_bbox"]
-            
-            if track_uuid not in frame_items: # keep first object for cropping later
-                obj_item ={"track_idx": track_idx, "frame_idx": frame_idx, "obj_idx": obj_idx, "bbox": bbox}
-                frame_items[track_uuid] = obj_item
-            
-            w, h = tracks[key]["obj_bbox"][2:]
-            try: 
-                (xm,ym),(ma,mi),angle = cv2.fitEllipse(tracks[key]["obj_contour"])
-                major_axis = max(ma,mi)
-                minor_axis = min(ma,mi)
-            except: 
-                major_axis = max(w,h)
-                minor_axis = min(w,h)
-            
-            if not np.isfinite(major_axis): major_axis = max(w,h)
-            if not np.isfinite(minor_axis): minor_axis = min(w,h)
-
-            match_error = tracks[key]["match_error"]
-
-            item = {
-                "track_uuid": track_uuid,
-                "frame_idx": frame_idx,
-                "track_idx": track_idx,
-                "obj_idx": obj_idx,
-                "x_pos": cent[0], 
-                "y_pos": cent[1], 
-                "area": area*px_um_cal**2, 
-                "major_axis": major_axis*px_um_cal,
-                "minor_axis": minor_axis*px_um_cal,
-                "match_error": match_error
-             }
-            
-            items.append(item)
+        
+        frame_idx = track["frame_idx"][0].item() # keep first object for cropping later
+        frame_items[track_uuid] = {"track_idx": track_idx, "frame_idx": frame_idx, 
+                                   "obj_idx": tracks[(track_idx, frame_idx)]["obj_idx"], 
+                                   "bbox": tracks[(track_idx, frame_idx)]["obj_bbox"]}
+        cent = track["obj_centroid"]
+
+        items = {
+            "track_uuid": track_uuid,
+            "frame_idx": track["frame_idx"],
+            "track_idx": track_idx,
+            "obj_idx": track["obj_idx"],
+            "x_pos": cent[:, 0], 
+            "y_pos": cent[:, 1], 
+            "area": track["obj_area"]*px_um_cal**2, 
+            "match_error": track["match_error"]
+            }
 
         df = pd.DataFrame(items)
   
         df["area_mean"] = df.area.mean()
-        df["major_axis_mean"] = df.major_axis.mean()
-        df["minor_axis_mean"] = df.major_axis.mean()
         df["vel_x_inst"] = (df.x_pos.diff()*px_um_cal)/dt/1e3 # convert um/s to mm/s
         df["vel_x_mean"] = df.vel_x_inst.mean()
 
@@ -152,8 +129,7 @@ def writer(output_path, tracks, objs, cap,
         df["vel_y_mean"] = df.vel_y_inst.mean()
         df["N_frames"] = len(df)
         
-        pts = np.array([(item["x_pos"], item["y_pos"]) for item in items])
-        vect = pts[1:]-pts[:-1]
+        vect = cent[1:]-cent[:-1]
         angles = np.array([angle_between(v, [0, 1]) for v in vect]) 
         df["angles"] = np.nan
         df.loc[1:, "angles"] = angles
@@ -187,6 +163,18 @@ def writer(output_path, tracks, objs, cap,
         dfx = dfx.loc[track_uuids]
         dfx.reset_index(inplace=True, drop=False)
 
+    # shape properties only for the objects of the tracks kept (see safas.morphology)
+    props = morphology([tracks[key] for key in zip(dfx["track_idx"], dfx["frame_idx"])])
+    loc = list(dfx.columns).index("area") + 1
+    for i, col in enumerate(["major_axis", "minor_axis", "equiv_diameter", "perimeter"]): 
+        dfx.insert(loc + i, col, props[f"obj_{col}"]*px_um_cal)
+    for col in ["circularity", "aspect_ratio"]: 
+        dfx.insert(list(dfx.columns).index("match_error"), col, props[f"obj_{col}"])
+    by_track = dfx.groupby("track_uuid", sort=False)
+    loc = list(dfx.columns).index("area_mean") + 1
+    dfx.insert(loc, "major_axis_mean", by_track["major_axis"].transform("mean").values)
+    dfx.insert(loc + 1, "minor_axis_mean", by_track["minor_axis"].transform("mean").values)
+
     if save_full_output: 
         dfx.to_csv(f"{output_path}/full_output.csv") # write full output
 
@@ -213,35 +201,34 @@ def writer(output_path, tracks, objs, cap,
         obj_path = str(Path(output_path).joinpath("objs"))
         os.makedirs(obj_path, exist_ok=True)
 
-        vi = 0
-        cap.set(cv2.CAP_PROP_POS_FRAMES, vi)
-        ret, src = cap.read() 
-
+        frame_uuids = dict() # group crops by frame so each frame is read once, in order
         for frame_uuid in frame_items: 
-            item = frame_items[frame_uuid]
-            
-            if item["frame_idx"] != vi: 
-                cap.set(cv2.CAP_PROP_POS_FRAMES, item["frame_idx"])
-                vi = item["frame_idx"]
-                ret, src = cap.read() 
-            
-            x, y, dx, dy = item["bbox"] 
-            pad = 5
-                    
-            ymin = np.clip(x-pad, a_min=0, a_max=src.shape[0]) 
-            ymax = np.clip(x+dx+pad, a_min=0, a_max=src.shape[0])
-            xmin = np.clip(y-pad, a_min=0, a_max=src.shape[1]) 
-            xmax = np.clip(y+dy+pad, a_min=0, a_max=src.shape[1])
-
-            obj_crop = src[xmin:xmax, ymin:ymax]
-            if not (np.array(obj_crop.shape) ==0).any(): 
-                fname = f"{item['track_idx']}-{item['frame_idx']}-{item['obj_idx']}-{frame_uuid}.png"
-                cv2.imwrite(str(Path(obj_path).joinpath(fname)), obj_crop)
+            frame_uuids.setdefault(frame_items[frame_uuid]["frame_idx"], []).append(frame_uuid)
+
+        # cap is a safas.frames.FrameCache, frames are cropped to cap.roi if set
+        roi = getattr(cap, "roi", None)
+        x0, y0 = (0, 0) if roi is None else roi[:2] 
+        for frame_idx, ret, src in cap.iter_frames(frame_uuids): 
+            for frame_uuid in frame_uuids[frame_idx]: 
+                item = frame_items[frame_uuid]
+                x, y, dx, dy = item["bbox"] 
+                x, y = x - x0, y - y0 # bbox is in full-frame coordinates
+                pad = 5
+                        
+                ymin = np.clip(x-pad, a_min=0, a_max=src.shape[0]) 
+                ymax = np.clip(x+dx+pad, a_min=0, a_max=src.shape[0])
+                xmin = np.clip(y-pad, a_min=0, a_max=src.shape[1]) 
+                xmax = np.clip(y+dy+pad, a_min=0, a_max=src.shape[1])
+
+                obj_crop = src[xmin:xmax, ymin:ymax]
+                if not (np.array(obj_crop.shape) ==0).any(): 
+                    fname = f"{item['track_idx']}-{item['frame_idx']}-{item['obj_idx']}-{frame_uuid}.png"
+                    cv2.imwrite(str(Path(obj_path).joinpath(fname)), obj_crop)
 
     if save_frames: 
         path = Path(output_path).joinpath("frames")
         os.makedirs(path, exist_ok=True)
-        frame_idxs = list(set([key[1] for key in tracks]))
+        frame_idxs = tracks.frame_idxs()
         print(f"Saving {len(frame_idxs)} frames")
         if len(frame_idxs) > 10: 
             n_threads = multiprocessing.cpu_count() - 1 
@@ -296,9 +283,7 @@ class FrameWriter():
         print('Frame writer done')
 
     def _producer(self, q_in, cap, frame_idxs, output_path):
-        for frame_idx in frame_idxs: 
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-            ret, frame = cap.read()
+        for frame_idx, ret, frame in cap.iter_frames(frame_idxs): 
             fname = str(f"{output_path}/{frame_idx:05d}.png")
             q_in.put((frame, fname, frame_idx))
         q_in.put((None, None, None))